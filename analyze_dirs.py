@@ -16,38 +16,10 @@ import traceback
 dirs=["/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1bc13/isr/2023-10-14/usrp-rx0-r_20231014T130000_20231015T041500"]
 for d in dirs:
     try:
+        # all receiver channels in one pass over the data
         olpi.lpi_files(dirname=d,
                        avg_dur=10,  # n seconds to average
-                       channel="zenith-l2",
-                       rg=30,       # how many microseconds is one range gate
-                       min_tx_frac=0.5, # of the pulse can be missing
-                       pass_band=0.018e6, # +/- 50 kHz 
-                       filter_len=100,    # short filter, less problems with correlated noise, more problems with RFI
-                       maximum_range_delay=7200,
-                       save_acf_images=True,
-                       lag_avg=1,
-                       reanalyze=False)
-    except:
-        traceback.print_exc()
-    try:
-        olpi.lpi_files(dirname=d,
-                       avg_dur=10,  # n seconds to average
-                       channel="zenith-l",
-                       rg=30,       # how many microseconds is one range gate
-                       min_tx_frac=0.5, # of the pulse can be missing
-                       pass_band=0.018e6, # +/- 50 kHz 
-                       filter_len=100,    # short filter, less problems with correlated noise, more problems with RFI
-                       maximum_range_delay=7200,
-                       save_acf_images=True,
-                       lag_avg=1,
-                       reanalyze=False)
-    except:
-        traceback.print_exc()
-        
-    try:
-        olpi.lpi_files(dirname=d,
-                       avg_dur=10,  # n seconds to average
-                       channel="misa-l",
+                       channel=["zenith-l2","zenith-l","misa-l"],
                        rg=30,       # how many microseconds is one range gate
                        min_tx_frac=0.5, # of the pulse can be missing
                        pass_band=0.018e6, # +/- 50 kHz 
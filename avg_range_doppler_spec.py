@@ -4,13 +4,16 @@ import matplotlib.pyplot as plt
 import pyfftw
 import stuffr
 import scipy.signal as s
+import scipy.fft as sfft
 from digital_rf import DigitalRFReader, DigitalMetadataReader, DigitalMetadataWriter
 import os
 import h5py
-from scipy.ndimage import median_filter
+from scipy.ndimage import median_filter, binary_dilation
 import traceback
 
 import millstone_radar_state as mrs
+import prefetch as prefetch_mod
+import tx_cache
 
 from mpi4py import MPI
 
@@ -30,6 +33,70 @@ def ideal_lpf(z,sr=1e6,f0=1.2*pass_band,L=200):
     z_filtered=n.roll(n.fft.ifft(Z*H),-L)
     return(z_filtered)
 
+class lpf_plan:
+    """
+    ideal_lpf of n_ch signals of length N in one batched FFTW transform, with the frequency response of
+    the filter calculated only once. the default is the same circular convolution over the whole signal
+    as ideal_lpf. with overlap_save=True the signals are filtered in fft_len sample blocks (overlap-save),
+    which is a linear convolution, i.e., the first and last L samples do not wrap around
+    """
+    def __init__(self,N,n_ch=2,sr=1e6,f0=1.2*pass_band,L=200,overlap_save=False,fft_len=4096,threads=1):
+        self.N=N
+        self.n_ch=n_ch
+        self.L=L
+        self.overlap_save=overlap_save
+        m=n.arange(-L,L)+1e-6
+        om0=n.pi*f0/(0.5*sr)
+        h=s.windows.hann(len(m))*n.sin(om0*m)/(n.pi*m)
+        if overlap_save:
+            # each block gives step valid output samples
+            self.step=fft_len-len(h)+1
+            self.n_blocks=int(n.ceil(N/self.step))
+            # the input is delayed by L-1 samples, so that the output needs no roll
+            self.x=n.zeros([n_ch,self.n_blocks*self.step+len(h)-1],dtype=n.complex64)
+            shape=(n_ch*self.n_blocks,fft_len)
+        else:
+            fft_len=N
+            shape=(n_ch,N)
+        self.H=n.array(n.fft.fft(h,fft_len),dtype=n.complex64)
+        if not overlap_save:
+            # roll by -L in the frequency domain
+            self.H=self.H*n.array(n.exp(2.0j*n.pi*n.fft.fftfreq(N)*L),dtype=n.complex64)
+        self.a=pyfftw.empty_aligned(shape,dtype=n.complex64)
+        self.b=pyfftw.empty_aligned(shape,dtype=n.complex64)
+        self.fwd=pyfftw.FFTW(self.a,self.b,axes=(1,),direction="FFTW_FORWARD",flags=("FFTW_MEASURE",),threads=threads)
+        self.bwd=pyfftw.FFTW(self.b,self.a,axes=(1,),direction="FFTW_BACKWARD",flags=("FFTW_MEASURE",),threads=threads)
+
+    def filter(self,z):
+        """
+        filter the rows of z (n_ch,N). returns a new (n_ch,N) array
+        """
+        if self.overlap_save:
+            self.x[:,(self.L-1):(self.L-1+self.N)]=z
+            fft_len=self.a.shape[1]
+            segments=n.lib.stride_tricks.sliding_window_view(self.x,fft_len,axis=1)[:,::self.step,:]
+            self.a[:,:]=segments.reshape(self.a.shape)
+        else:
+            self.a[:,:]=z
+        self.fwd()
+        self.b*=self.H
+        self.bwd()
+        if self.overlap_save:
+            y=self.a[:,(fft_len-self.step):].reshape([self.n_ch,self.n_blocks*self.step])
+            return(n.array(y[:,0:self.N]))
+        return(n.array(self.a))
+
+lpf_plans={}
+
+def ideal_lpf_batch(z,sr=1e6,f0=1.2*pass_band,L=200,overlap_save=False):
+    """
+    ideal_lpf of the rows of z (n_ch,N) at once, using a cached lpf_plan for each signal length and pass band
+    """
+    key=(z.shape,sr,f0,L,overlap_save)
+    if key not in lpf_plans.keys():
+        lpf_plans[key]=lpf_plan(z.shape[1],n_ch=z.shape[0],sr=sr,f0=f0,L=L,overlap_save=overlap_save)
+    return(lpf_plans[key].filter(z))
+
 def estimate_dc(d_il,tmm,sid,channel):
     # estimate dc offset first
     z_dc=n.zeros(10000,dtype=n.complex64)
@@ -88,17 +155,245 @@ def estimate_tsys(tmm,sid,key,d_il,z_echo):
     T_sys2=noise2/alpha
     return(T_sys,T_sys2)
 
-def range_dop_spec(z_echo,z_tx,rgs,tx0,tx1,fftlen):
+class range_dop_plan:
+    """
+    pre-planned FFTW transform of the range-Doppler spectrum for n_rg range gates, txlen long
+    echo segments and fftlen frequency bins. the zero padding of the input array is only set once
+    """
+    def __init__(self,n_rg,txlen,fftlen,threads=1):
+        self.txlen=txlen
+        # try to reduce the doppler spread of the ambiguity function
+        self.wf=s.windows.hann(txlen)
+        # the input is multiplied with this
+        self.chirp=n.ones(txlen,dtype=n.complex64)
+        self.a=pyfftw.empty_aligned((n_rg,fftlen),dtype=n.complex64)
+        self.b=pyfftw.empty_aligned((n_rg,fftlen),dtype=n.complex64)
+        self.fft=pyfftw.FFTW(self.a,self.b,axes=(1,),direction="FFTW_FORWARD",flags=("FFTW_MEASURE",),threads=threads)
+        self.a[:,:]=0.0
+
+    def spec(self):
+        """
+        power spectra of the rows of a[:,0:txlen], fftshifted
+        """
+        self.fft()
+        return(n.array(n.fft.fftshift(self.b.real**2.0+self.b.imag**2.0,axes=1),dtype=n.float32))
+
+class zoom_dop_plan:
+    """
+    chirp-z (Bluestein) transform that only evaluates the fftshifted frequency bins fi0:fi1 of a
+    fftlen point FFT, i.e., the same Doppler bins dop_hz[fi0:fi1]. the convolution with the chirp
+    is done with pre-planned FFTW transforms of length next_fast_len(txlen+fi1-fi0-1), which is
+    much shorter than fftlen when the pass band is narrow.
+
+    X[k0+m] = sum_t x_t w^{k0 t} w^{m t}, w=exp(-2 pi i/fftlen) and m t = (m^2 + t^2 - (m-t)^2)/2.
+    the chirp w^{m^2/2} after the convolution has unit magnitude, so it is not needed for the power.
+    the chirp phases are calculated modulo 2 fftlen with integers, so they are exact.
+    """
+    def __init__(self,n_rg,txlen,fftlen,fi0,fi1,threads=1):
+        self.txlen=txlen
+        self.wf=s.windows.hann(txlen)
+        n_freq=fi1-fi0
+        self.n_freq=n_freq
+        # first frequency bin, fftshifted index fi0
+        k0=fi0-fftlen//2
+        t=n.arange(txlen,dtype=n.int64)
+        self.chirp=n.array(n.exp(-2j*n.pi*((k0*t)%fftlen)/fftlen)*n.exp(-1j*n.pi*((t*t)%(2*fftlen))/fftlen),dtype=n.complex64)
+
+        conv_len=sfft.next_fast_len(txlen+n_freq-1)
+        m=n.arange(n_freq,dtype=n.int64)
+        j=n.arange(1,txlen,dtype=n.int64)
+        v=n.zeros(conv_len,dtype=n.complex128)
+        v[m]=n.exp(1j*n.pi*((m*m)%(2*fftlen))/fftlen)
+        v[conv_len-j]=n.exp(1j*n.pi*((j*j)%(2*fftlen))/fftlen)
+        self.V=n.array(n.fft.fft(v),dtype=n.complex64)
+
+        self.a=pyfftw.empty_aligned((n_rg,conv_len),dtype=n.complex64)
+        self.b=pyfftw.empty_aligned((n_rg,conv_len),dtype=n.complex64)
+        self.fwd=pyfftw.FFTW(self.a,self.b,axes=(1,),direction="FFTW_FORWARD",flags=("FFTW_MEASURE",),threads=threads)
+        self.bwd=pyfftw.FFTW(self.b,self.a,axes=(1,),direction="FFTW_BACKWARD",flags=("FFTW_MEASURE",),threads=threads)
+        self.a[:,:]=0.0
+
+    def spec(self):
+        """
+        power spectra of the rows of a[:,0:txlen] in the frequency bins fi0:fi1
+        """
+        self.fwd()
+        self.b*=self.V
+        self.bwd()
+        X=self.a[:,0:self.n_freq]
+        P=n.array(X.real**2.0+X.imag**2.0,dtype=n.float32)
+        # the transform overwrites the zero padding
+        self.a[:,self.txlen:]=0.0
+        return(P)
+
+rds_plans={}
+
+def range_dop_spec(z_echo,z_tx,rgs,tx0,tx1,fftlen,fi0=None,fi1=None):
+    """
+    range-Doppler spectrum |FFT(w z_tx^* z_echo[rg:(rg+tx1)])|^2 of all range gates rgs.
+    the range shifted echo segments are a strided view of z_echo, which are multiplied with the
+    windowed transmit pulse and transformed with one pre-planned FFTW transform.
+
+    if fi0 and fi1 are given, only the fftshifted frequency bins fi0:fi1 are calculated, with a chirp-z
+    transform. this is the same as range_dop_spec(...)[:,fi0:fi1]
+    """
     n_rg=len(rgs)
-    RDS=n.zeros([n_rg,fftlen],dtype=n.float32)
-    z_tx=n.copy(n.conj(z_tx))
     txlen=tx1
-    # try to reduce the doppler spread of the ambiguity function
-    wf=s.windows.hann(txlen)
-    for ri in range(n_rg):
-        RDS[ri,:]=n.abs(n.fft.fftshift(n.fft.fft(wf*z_tx[0:tx1]*z_echo[ (rgs[ri]):(rgs[ri]+txlen) ],fftlen)))**2.0
-    return(RDS)
-
+    key=(n_rg,txlen,fftlen,fi0,fi1)
+    if key not in rds_plans.keys():
+        if fi0 is None:
+            rds_plans[key]=range_dop_plan(n_rg,txlen,fftlen)
+        else:
+            rds_plans[key]=zoom_dop_plan(n_rg,txlen,fftlen,fi0,fi1)
+    plan=rds_plans[key]
+
+    # all txlen long segments of the echo, without copying
+    segments=n.lib.stride_tricks.sliding_window_view(z_echo,txlen)
+    rgs=n.array(rgs,dtype=int)
+    dr=1
+    if n_rg > 1:
+        dr=rgs[1]-rgs[0]
+    if n_rg > 1 and dr > 0 and n.all(n.diff(rgs) == dr):
+        # evenly spaced range gates are a strided view as well
+        segments=segments[rgs[0]::dr][0:n_rg]
+    else:
+        segments=segments[rgs]
+    n.multiply(segments,plan.wf*n.conj(z_tx[0:txlen])*plan.chirp,out=plan.a[:,0:txlen])
+    return(plan.spec())
+
+
+def hard_target_mask(det,rg_pad=16,n_blocks=2):
+    """
+    range gates to remove around hard target detections det (n_blocks,n_rg), one row per n_avg0 pulse block.
+    the range gates -rg_pad..rg_pad-1 around a detection are removed from the block and the n_blocks-1
+    blocks after it. the last range gate is never removed
+    """
+    mask=binary_dilation(det,structure=n.ones([n_blocks,2*rg_pad],dtype=bool),origin=(-(n_blocks//2),0))
+    mask[:,det.shape[1]-1]=False
+    return(mask)
+
+def hard_target_detections(ratio_det,rg_pad=16):
+    """
+    hard target detections from the ratio test ratio_det (n_blocks,n_rg). a block is not tested at the range
+    gates that the previous block already removed from it
+    """
+    det=n.copy(ratio_det)
+    for bi in range(1,det.shape[0]):
+        det[bi,:]=det[bi,:] & (hard_target_mask(det[(bi-1):bi,:],rg_pad,n_blocks=1)[0] == False)
+    return(det)
+
+
+class streaming_average:
+    """
+    average of the range-Doppler spectra of one integration window, one pulse at a time, without
+    keeping the spectra of all pulses in memory. the same as the outlier removing average of
+    avg_range_doppler_spectra:
+
+    - the noise level (sigma) of each range and Doppler bin is twice the 34th percentile over the pulses.
+      it is estimated from the first n_reservoir pulses, which are kept until the estimate is available
+    - n_avg0 pulse blocks with a range gate above ratio_threshold*sigma are hard targets. the range gates
+      -16..+15 around them are removed from this block and the next one (hard_target_mask)
+    - the pulses of the last incomplete block are not used
+
+    with at most n_reservoir pulses, the result is the same as with all pulses in memory.
+    avg_type="mean" is a plain average. the state is O(n_rg*n_freq), apart from the reservoir
+    """
+    def __init__(self,n_rg,n_freq,avg_type="outlier_mean",n_reservoir=100,n_avg0=6,ratio_threshold=7.0):
+        self.n_rg=n_rg
+        self.avg_type=avg_type
+        self.n_avg0=n_avg0
+        self.ratio_threshold=ratio_threshold
+        self.n_reservoir=max(n_reservoir,n_avg0)
+        self.reservoir=[]
+        self.lp_sigma_est=None
+        # running sums of all pulses for the variance
+        self.n_pulses=0
+        self.S1=n.zeros([n_rg,n_freq],dtype=n.float64)
+        self.S2=n.zeros([n_rg,n_freq],dtype=n.float64)
+        # the current block, and the range gates removed from it by the previous block
+        self.block=[]
+        self.block_t=[]
+        self.carry=n.zeros(n_rg,dtype=bool)
+        # hard target detections of each block and the time of its first pulse
+        self.det=[]
+        self.det_t=[]
+        self.n_removed=n.zeros(n_rg,dtype=int)
+        # sum and count of the pulses that are not removed
+        self.n_used=0
+        self.S_ok=n.zeros([n_rg,n_freq],dtype=n.float64)
+        self.N_ok=n.zeros(n_rg,dtype=n.float64)
+
+    def add(self,RDS,t=0):
+        """
+        add the range-Doppler spectrum (n_rg,n_freq) of one pulse transmitted at t
+        """
+        self.n_pulses+=1
+        self.S1+=RDS
+        self.S2+=n.array(RDS,dtype=n.float64)**2.0
+        if self.avg_type == "mean":
+            return
+        if self.lp_sigma_est is None:
+            self.reservoir.append((n.copy(RDS),t))
+            if len(self.reservoir) >= self.n_reservoir:
+                self.estimate_sigma()
+            return
+        self.add_block(RDS,t)
+
+    def estimate_sigma(self):
+        """
+        noise level from the pulses in the reservoir, which are then averaged
+        """
+        # there can be a lot of outliers, so we estimate 0.5 sigma
+        # from the distribution
+        self.lp_sigma_est=n.percentile(n.array([r[0] for r in self.reservoir]),34,axis=0)*2
+        # smooth a bit
+        self.lp_sigma_est=median_filter(self.lp_sigma_est,11)
+        reservoir=self.reservoir
+        self.reservoir=[]
+        for RDS,t in reservoir:
+            self.add_block(RDS,t)
+
+    def add_block(self,RDS,t=0):
+        """
+        collect n_avg0 pulses, do the hard target test on their average and add the good range gates
+        """
+        self.block.append(RDS)
+        self.block_t.append(t)
+        if len(self.block) < self.n_avg0:
+            return
+        block=n.array(self.block)
+        t0=self.block_t[0]
+        self.block=[]
+        self.block_t=[]
+        RDS_THIS=n.mean(block,axis=0)
+        # not tested at the range gates removed by the previous block
+        det=n.any(RDS_THIS/self.lp_sigma_est > self.ratio_threshold,axis=1) & (self.carry == False)
+        if n.any(det):
+            self.det.append(det)
+            self.det_t.append(t0)
+        # remove range ambiguity length around from every detected hard target echo
+        bad=hard_target_mask(det[None,:],n_blocks=1)[0]
+        remove=bad | self.carry
+        # take a bit extra after
+        self.carry=bad
+        self.n_removed+=remove
+        good=n.where(remove == False)[0]
+        self.S_ok[good,:]+=n.sum(block[:,good,:],axis=0)
+        self.N_ok[good]+=self.n_avg0
+        self.n_used+=self.n_avg0
+
+    def result(self):
+        """
+        average, variance over all pulses and the number of pulses used
+        """
+        if self.avg_type != "mean" and self.lp_sigma_est is None and len(self.reservoir) > 0:
+            self.estimate_sigma()
+        m=self.S1/self.n_pulses
+        RDS_var=n.array(self.S2/self.n_pulses-m**2.0,dtype=n.float32)
+        if self.avg_type == "mean":
+            return(n.array(m,dtype=n.float32),RDS_var,self.n_pulses)
+        RDS=n.array(self.S_ok/self.N_ok[:,None],dtype=n.float32)
+        return(RDS,RDS_var,self.n_used)
 
 # sample rate for metadata
 idsr=1000000
@@ -177,7 +472,13 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
                               channel="zenith-l",
                               avg_type="outlier_removal",
                               postfix="_outlier",
-                              mode=300
+                              mode=300,
+                              prefetch=True,  # read the next integration window in a background thread
+                              tx_cache_corr=None,  # reuse the range-Doppler ambiguity function while the normalized correlation of the transmit pulse stays above this (e.g., 0.999). None disables
+                              zoom_fft=True,  # only calculate the Doppler bins of the pass band, with a chirp-z transform
+                              streaming=False, # average one pulse at a time, instead of keeping the spectra of all pulses in memory
+                              n_reservoir=100, # streaming. number of pulses used to estimate the noise level for the outlier removal
+                              overlap_save=False  # low-pass filter the pulses in blocks (linear convolution) instead of one circular convolution
                               ):
 
 
@@ -224,7 +525,108 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
     noise_r1_km=lp_data[mode]["noise_r1_km"]
     gc=tmm[mode]["gc"]
 
-    # go through one integration window
+    # USRP DC offset bug due to truncation instead of rounding.
+    # Ryan Volz has a fix for firmware in USRPs.
+    z_dc=n.complex64(-0.212-0.221j)
+    if channel=="zenith-l2":
+        z_dc=0.0
+
+    if prefetch:
+        # the background thread gets its own readers
+        id_read_w = DigitalMetadataReader("%s/metadata/id_metadata"%(dirname))
+        d_il_w = DigitalRFReader("%s/rf_data/"%(dirname))
+    else:
+        id_read_w = id_read
+        d_il_w = d_il
+
+    def load_window(ai):
+        """
+        read the dc corrected echoes and transmit samples of all pulses of integration window ai
+        that are in this mode, with enough transmit power and the right antenna
+        """
+        i0 = ai*int(step*idsr) + idb[0]
+
+        # get info on all the pulses transmitted during this averaging interval
+        # get some extra for gc
+        sid = id_read_w.read(i0,i0+int(avg_dur*idsr)+40000,"sweepid")
+
+        sidkeys=list(sid.keys())
+        pulses=[]
+        for keyi in range(0,len(sidkeys)):
+            key=sidkeys[keyi]
+
+            if sid[key] != mode:
+#                print("wrong mode %d != %d. ignoring."%(sid[key],mode))
+                continue
+
+            if sid[key] not in tmm.keys():
+                #print("unknown pulse code %d encountered, skipping."%(sid[key]))
+                continue
+
+#            print("pulse id %d"%(sid[key]))
+
+            # how many samples do we read
+            read_length=tmm[sid[key]]["read_length"]
+
+            z_echo=None
+            z_tx=None
+
+            zenith_pwr=zpm(key/1e6)
+            misa_pwr=mpm(key/1e6)
+            if sid[key] == 300:
+
+                if (tx_ant(key) < -0.99) and (rx_ant(key) < -0.99) and (channel == "zenith-l") and (zenith_pwr > min_tx_pwr):
+                    try:
+                        z_echo = d_il_w.read_vector_c81d(key, read_length, "zenith-l") - z_dc
+                        z_tx = d_il_w.read_vector_c81d(key, read_length, "tx-h")# - z_dc
+                        tx_pwr=zenith_pwr
+                    except:
+                        traceback.print_exc()
+                        print("couldn't read %d %s"%(key,"zenith-l"))
+                        continue
+                elif (tx_ant(key) > 0.99) and (rx_ant(key) > 0.99) and (channel == "misa-l") and (misa_pwr > min_tx_pwr):
+                    try:
+                        z_echo = d_il_w.read_vector_c81d(key, read_length, "misa-l") - z_dc
+                        z_tx = d_il_w.read_vector_c81d(key, read_length, "tx-h")# - z_dc
+                        tx_pwr=misa_pwr
+                    except:
+                        traceback.print_exc()
+                        print("couldn't read %d %s %s"%(key,"misa-l",stuffr.unix2datestr(key/1e6)))
+                        continue
+                else:
+#                    print("not enough tx power (%1.0f,%1.0f MW) on %s skipping this pulse"%(zpm(key/1e6)/1e6,mpm(key/1e6)/1e6,channel))
+                    continue
+
+            elif sid[key]==800:
+                # if there is enough power on misa, the tx and rx are switched to misa, and we are
+                # analyzing misa
+                if (tx_ant(key) > 0.99) and (rx_ant(key) > 0.99) and (channel == "misa-l") and (misa_pwr > min_tx_pwr):
+                    z_echo = d_il_w.read_vector_c81d(key, read_length, "misa-l") - z_dc
+                    z_tx = d_il_w.read_vector_c81d(key, read_length, "tx-h")# - z_dc
+                    tx_pwr=misa_pwr
+                else:
+#                    print("not enough power")
+                    continue
+
+            else:
+                continue
+            pulses.append((key,z_echo,z_tx,tx_pwr))
+        return({"i0":i0,"sid":sid,"pulses":pulses})
+
+    def tx_range_dop_spec(z_tx):
+        """
+        range-Doppler ambiguity function in the pass band
+        """
+        # use this to estimate the range-Doppler ambiguity function
+        z_tx2=n.copy(z_tx)
+        z_tx2=n.roll(z_tx2,range_shift)
+        if zoom_fft:
+            return(range_dop_spec(z_tx2,z_tx,rgs,tx0,tx1,fft_length,fi0,fi1))
+        return(range_dop_spec(z_tx2,z_tx,rgs,tx0,tx1,fft_length)[:,fi0:fi1])
+
+    tx_rds_cache=tx_cache.ambiguity_cache(tx_range_dop_spec,min_corr=tx_cache_corr)
+
+    todo=[]
     for ai in range(rank,n_times,size):
         i0 = ai*int(step*idsr) + idb[0]
         print(stuffr.unix2datestr(i0/1e6))
@@ -232,18 +634,26 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
         if os.path.exists("%s/range_doppler_%d%s/%s/il_%d.png"%(dirname,mode,postfix,channel,int(i0/1e6))) and reanalyze==False:
             print("already analyzed %d"%(i0/1e6))
             continue
+        todo.append(ai)
 
+    # go through one integration window, while the next one is read in the background
+    for ai,window in prefetch_mod.iterate_windows(load_window,todo,prefetch=prefetch):
+        if window is None:
+            print("couldn't read integration window %d"%(ai))
+            continue
 
         try:
-
-
-            # get info on all the pulses transmitted during this averaging interval
-            # get some extra for gc
-            sid = id_read.read(i0,i0+int(avg_dur*idsr)+40000,"sweepid")
+            i0=window["i0"]
+            sid=window["sid"]
 
             n_pulses=len(sid.keys())
 
-            RDS_LP=n.zeros([n_pulses, n_rg, n_freq],dtype=n.float32)
+            if streaming:
+                avg=streaming_average(n_rg,n_freq,avg_type=avg_type,n_reservoir=n_reservoir)
+            else:
+                RDS_LP=n.zeros([n_pulses, n_rg, n_freq],dtype=n.float32)
+                # transmit time of each pulse
+                pulse_t=[]
             RDS_LP_var=n.zeros([n_rg, n_freq],dtype=n.float32)
             W_LP=n.zeros(n_pulses,dtype=n.float32)
             # range-doppler ambiguity function
@@ -257,85 +667,16 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
             T_sys_a=[]
             T_sys_m=[]
 
-            # USRP DC offset bug due to truncation instead of rounding.
-            # Ryan Volz has a fix for firmware in USRPs.
-
-            z_dc=n.complex64(-0.212-0.221j)
-            if channel=="zenith-l2":
-                z_dc=0.0
-
             bg_samples=[]
             bg_plus_inj_samples=[]
 
             avg_tx_pwr=0.0
             avg_tx_pwr_samples=0
 
-            sidkeys=list(sid.keys())
-
-            for keyi in range(0,n_pulses):
-                key=sidkeys[keyi]
-
-                if sid[key] != mode:
-#                    print("wrong mode %d != %d. ignoring."%(sid[key],mode))
-                    continue
-
-                if sid[key] not in tmm.keys():
-                    #print("unknown pulse code %d encountered, skipping."%(sid[key]))
-                    continue
-
-#                print("pulse id %d"%(sid[key]))
-
-                # how many samples do we read
+            for key,z_echo,z_tx,tx_pwr in window["pulses"]:
                 read_length=tmm[sid[key]]["read_length"]
-
-                z_echo=None
-                z_tx=None
-
-                zenith_pwr=zpm(key/1e6)
-                misa_pwr=mpm(key/1e6)            
-                if sid[key] == 300:
-
-                    if (tx_ant(key) < -0.99) and (rx_ant(key) < -0.99) and (channel == "zenith-l") and (zenith_pwr > min_tx_pwr):
-                        try:
-                            z_echo = d_il.read_vector_c81d(key, read_length, "zenith-l") - z_dc
-                            z_tx = d_il.read_vector_c81d(key, read_length, "tx-h")# - z_dc                        
-                            avg_tx_pwr+=zenith_pwr
-                            avg_tx_pwr_samples+=1
-                        except:
-                            traceback.print_exc()                        
-                            print("couldn't read %d %s"%(key,"zenith-l"))
-                            continue
-                    elif (tx_ant(key) > 0.99) and (rx_ant(key) > 0.99) and (channel == "misa-l") and (misa_pwr > min_tx_pwr):
-                        try:
-                            z_echo = d_il.read_vector_c81d(key, read_length, "misa-l") - z_dc
-                            z_tx = d_il.read_vector_c81d(key, read_length, "tx-h")# - z_dc
-
-                            avg_tx_pwr+=misa_pwr
-                            avg_tx_pwr_samples+=1
-                        except:
-                            traceback.print_exc()
-                            print("couldn't read %d %s %s"%(key,"misa-l",stuffr.unix2datestr(key/1e6)))
-                            continue
-                    else:
-#                        print("not enough tx power (%1.0f,%1.0f MW) on %s skipping this pulse"%(zpm(key/1e6)/1e6,mpm(key/1e6)/1e6,channel))
-                        continue
-
-                elif sid[key]==800:
-                    # if there is enough power on misa, the tx and rx are switched to misa, and we are
-                    # analyzing misa
-                    if (tx_ant(key) > 0.99) and (rx_ant(key) > 0.99) and (channel == "misa-l") and (misa_pwr > min_tx_pwr):
-                        z_echo = d_il.read_vector_c81d(key, read_length, "misa-l") - z_dc
-                        z_tx = d_il.read_vector_c81d(key, read_length, "tx-h")# - z_dc
-
-                        avg_tx_pwr+=misa_pwr
-                        avg_tx_pwr_samples+=1
-
-                    else:
-#                        print("not enough power")
-                        continue
-
-                else:
-                    continue
+                avg_tx_pwr+=tx_pwr
+                avg_tx_pwr_samples+=1
 
                 # we only procede here if we have enough power and we have a known mode
 
@@ -359,8 +700,8 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
                     plt.plot(n.abs(z_echo))
                     plt.show()
 
-                z_echo=ideal_lpf(z_echo)
-                z_tx=ideal_lpf(z_tx)
+                # echo and transmit pulse in one transform
+                z_echo,z_tx=ideal_lpf_batch(n.array([z_echo,z_tx]),overlap_save=overlap_save)
 
                 bg_samples.append( n.mean(n.abs(z_echo[(last_echo-500):last_echo])**2.0) )
                 bg_plus_inj_samples.append( n.mean(n.abs(z_echo[(noise0):noise1])**2.0) )
@@ -370,15 +711,20 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
                 z_echo[0:gc]=0.0
                 z_echo[last_echo:read_length]=0.0
 
-                # use this to estimate the range-Doppler ambiguity function
-                z_tx2=n.copy(z_tx)
-                z_tx2=n.roll(z_tx2,range_shift)
-
-                RDS=range_dop_spec(z_echo,z_tx,rgs,tx0,tx1,fft_length)
-                TX_RDS=range_dop_spec(z_tx2,z_tx,rgs,tx0,tx1,fft_length)
+                if zoom_fft:
+                    # only the pass band
+                    RDS=range_dop_spec(z_echo,z_tx,rgs,tx0,tx1,fft_length,fi0,fi1)
+                else:
+                    RDS=range_dop_spec(z_echo,z_tx,rgs,tx0,tx1,fft_length)[:,fi0:fi1]
+                # the range-Doppler ambiguity function only changes when the transmitter drifts
+                TX_RDS=tx_rds_cache.get(sid[key],z_tx)
 
-                RDS_LP[lp_idx,:,:]=RDS[:,fi0:fi1]
-                TX_RDS_LP[:,:]+=TX_RDS[:,fi0:fi1]
+                if streaming:
+                    avg.add(RDS,key)
+                else:
+                    RDS_LP[lp_idx,:,:]=RDS
+                    pulse_t.append(key)
+                TX_RDS_LP[:,:]+=TX_RDS
                 lp_idx+=1
 
             # go through all supported modes
@@ -393,41 +739,55 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
             # this is the most aggressive method I know of doing an average, but it might 
             # be a bit too aggressive. I don't even know if this is an unbiased estimator
             use_median_mean=False
-            if avg_type=="median":
-                RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)                        
-                RDS_LP=n.median(RDS_LP[0:lp_idx,:,:],axis=0)
-            if avg_type=="mean":
-                RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)            
-                RDS_LP=n.mean(RDS_LP[0:lp_idx,:,:],axis=0)
-
+            # hard targets removed by the outlier removal. one row for each n_avg0 pulse block with a detection
+            so_det=n.zeros([0,n_rg],dtype=bool)
+            so_t=n.zeros(0,dtype=n.int64)
+            space_object_count=n.zeros(n_rg,dtype=int)
+            if streaming:
+                RDS_LP,RDS_LP_var,lp_idx=avg.result()
+                if len(avg.det) > 0:
+                    so_det=n.array(avg.det)
+                    so_t=n.array(avg.det_t,dtype=n.int64)
+                space_object_count=avg.n_removed
             else:
-                # distribution statistics
-                # there can be a lot of outliers, so we estimate 0.5 sigma
-                # from the distribution
-                lp_sigma_est=n.percentile(RDS_LP[0:lp_idx,:,:],34,axis=0)*2
+                if avg_type=="median":
+                    RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)                        
+                    RDS_LP=n.median(RDS_LP[0:lp_idx,:,:],axis=0)
+                if avg_type=="mean":
+                    RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)            
+                    RDS_LP=n.mean(RDS_LP[0:lp_idx,:,:],axis=0)
 
-                # smooth a bit
-                lp_sigma_est=median_filter(lp_sigma_est,11)
+                else:
+                    # distribution statistics
+                    # there can be a lot of outliers, so we estimate 0.5 sigma
+                    # from the distribution
+                    lp_sigma_est=n.percentile(RDS_LP[0:lp_idx,:,:],34,axis=0)*2
+
+                    # smooth a bit
+                    lp_sigma_est=median_filter(lp_sigma_est,11)
 
-                RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)
+                    RDS_LP_var=n.var(RDS_LP[0:lp_idx,:,:],axis=0)
 
-                n_avg0=6
-                lp_idx=int(n.floor(lp_idx/n_avg0)*n_avg0)
-                for i in range(0,lp_idx,n_avg0):
-                    RDS_THIS=n.mean(RDS_LP[i:(i+n_avg0),:,:],axis=0)
-                    ratio_test=RDS_THIS/lp_sigma_est
+                    n_avg0=6
+                    lp_idx=int(n.floor(lp_idx/n_avg0)*n_avg0)
+                    n_blocks=int(lp_idx/n_avg0)
+                    RDS_THIS=n.mean(RDS_LP[0:lp_idx,:,:].reshape([n_blocks,n_avg0,n_rg,n_freq]),axis=1)
 
+                    # outlier reject 7-sigma
+                    det=hard_target_detections(n.any(RDS_THIS/lp_sigma_est[None,:,:] > 7,axis=2))
                     # remove range ambiguity length around from every detected hard target echo
-                    # outlier reject 5-sigma            
-                    bidx=n.where(ratio_test > 7)[0]
-                    for bi in bidx:
-    #                    print("Hard target at %1.0f km"%(rgs_km[bi]))
-                        # take a bit extra after
-                        for j in range(n_avg0*2):
-                            if (i+j) < RDS_LP.shape[0]:
-                                RDS_LP[i+j,(n.max([0,bi-16])):(n.min([n_rg-1,bi+16])),:]=n.nan
+                    # and take a bit extra after
+                    bad=hard_target_mask(det)
+                    good=n.repeat(bad == False,n_avg0,axis=0)
+
+                    bidx=n.where(n.any(det,axis=1))[0]
+                    so_det=det[bidx,:]
+                    so_t=n.array(pulse_t,dtype=n.int64)[bidx*n_avg0]
+                    space_object_count=n.sum(bad,axis=0)
 
-                RDS_LP=n.nanmean(RDS_LP[0:lp_idx,:,:],axis=0)
+                    # range gates removed from all pulses are nan
+                    with n.errstate(invalid="ignore"):
+                        RDS_LP=n.einsum("prf,pr->rf",RDS_LP[0:lp_idx,:,:],good)/n.sum(good,axis=0)[:,None]
 
 
             # scale to kelvins
@@ -479,6 +839,11 @@ def avg_range_doppler_spectra(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1
                 ho["channel"]=channel
                 ho["P_tx"]=avg_tx_pwr/avg_tx_pwr_samples
                 ho["mode"]=mode
+                # hard targets: time of the n_avg0 pulse block and range of each detection
+                so_bi,so_ri=n.where(so_det)
+                ho["space_object_times"]=so_t[so_bi]
+                ho["space_object_rgs"]=rgs_km[so_ri]
+                ho["space_object_count"]=space_object_count
                 ho.close()
         except:
             traceback.print_exc()
@@ -530,6 +530,12 @@ def fit_lpifiles(dirn="lpi_f",
             #a[0:rg_clutter_rem_cutoff,:]=a_g[0:rg_clutter_rem_cutoff,:]
             
             v=h["acfs_var"][()]/ampgain**2.0
+            if "acfs_g_var" in h.keys():
+                # acfs_g has its own variance when it is only estimated at low ranges
+                if gc_cancel_all_ranges:
+                    v=h["acfs_g_var"][()]/ampgain**2.0
+                else:
+                    v[0:rg_clutter_rem_cutoff,:]=h["acfs_g_var"][()][0:rg_clutter_rem_cutoff,:]/ampgain**2.0
 
             tsys+=h["T_sys"][()]            
 
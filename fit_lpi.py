@@ -594,6 +594,12 @@ def fit_lpifiles(dirn="lpi_f",
             #a[0:rg_clutter_rem_cutoff,:]=a_g[0:rg_clutter_rem_cutoff,:]
             
             v=h["acfs_var"][()]
+            if "acfs_g_var" in h.keys():
+                # acfs_g has its own variance when it is only estimated at low ranges
+                if gc_cancel_all_ranges:
+                    v=h["acfs_g_var"][()]
+                else:
+                    v[0:rg_clutter_rem_cutoff,:]=h["acfs_g_var"][()][0:rg_clutter_rem_cutoff,:]
             tsys+=h["T_sys"][()]            
 
             debris=n.zeros(n_rg,dtype=bool)
@@ -18,10 +18,17 @@ from scipy import sparse
 from mpi4py import MPI
 import scipy.signal as ss
 import scipy.constants as c
+import scipy.linalg as sla
+import scipy.sparse.linalg as spla
 import traceback
 import time
+import collections
+import glob
 
 import millstone_radar_state as mrs
+import prefetch as prefetch_mod
+import tx_cache
+import prescreen as prescreen_mod
 
 comm=MPI.COMM_WORLD
 size=comm.Get_size()
@@ -65,6 +72,49 @@ class simple_decimator:
         decL=int(n.floor(len(z)/self.dec))
         return(n.sum(z[self.idxm[0:decL,:]],axis=1))
 
+def lagged_products(z,lags,dec):
+    """
+    decimated lagged products z_t z_{t+lag}^* for all lags at once.
+
+    returns a (len(lags), floor(len(z)/dec)) array. row li is the same as
+    simple_decimator.decimate(z[0:(L-lags[li])]*n.conj(z[lags[li]:L])). blocks that run
+    past the end of the shifted vector are zero padded instead of dropped.
+
+    the decimation is the same block sum as in simple_decimator, done with a reshape instead
+    of an index gather, so the magic constant stays the same.
+    """
+    L=len(z)
+    lags=n.array(lags,dtype=int)
+    decL=int(n.floor(L/dec))
+    zp=n.zeros(L+n.max(lags),dtype=z.dtype)
+    zp[0:L]=z
+    # shifted copies z_{t+lag} for all lags, gathered from a zero-copy sliding window view
+    zs=n.lib.stride_tricks.sliding_window_view(zp,decL*dec)[lags,:]
+    P=z[0:(decL*dec)]*n.conj(zs)
+    P.shape=(len(lags),decL,dec)
+    return(n.sum(P,axis=2))
+
+def coarsen_products(x,f):
+    """
+    sum f neighbouring range gates of decimated lagged products x (n_lags, n_gates).
+    this is the same as decimating f times more to begin with, as the decimation is a block sum
+    """
+    if f == 1:
+        return(x)
+    n_blocks=int(n.floor(x.shape[1]/f))
+    return(n.sum(x[:,0:(n_blocks*f)].reshape((x.shape[0],n_blocks,f)),axis=2))
+
+def early_decimation_factor(lags,rg,pass_band,sr=1e6):
+    """
+    largest decimation factor that divides the range gate and all lags, and
+    still samples the low pass filtered (+/- 1.2*pass_band) signal above the Nyquist rate
+    """
+    d=int(n.gcd.reduce(n.concatenate([[rg],lags])))
+    for dec in range(d,0,-1):
+        if (d % dec == 0) and (sr/dec >= 2*1.2*pass_band):
+            return(dec)
+    return(1)
+
 class fft_lpf:
     def __init__(self,z_len=10000,sr=1e6,f0=1.2*0.1e6,L=20):
         m=n.arange(-L,L)+1e-6
@@ -85,6 +135,107 @@ class fft_lpf:
         
 
 
+class pulse_reader:
+    """
+    reads the pulses of a whole integration window with one contiguous read, and hands
+    out pulses as zero-copy views into that block. this avoids reading and decoding the
+    pulses used for ground clutter subtraction twice.
+
+    pulses outside the block (or all of them, if the block read fails due to a gap in the data)
+    are read one at a time and kept in a small LRU cache keyed by sample index.
+
+    the dc offset is removed when reading. the returned vectors are views, so copy them before
+    modifying them in place.
+    """
+    def __init__(self,d_il,channel,read_len=10000,z_dc=0.0,cache_size=16):
+        self.d_il=d_il
+        self.channel=channel
+        self.read_len=read_len
+        self.z_dc=z_dc
+        self.cache_size=cache_size
+        self.cache=collections.OrderedDict()
+        self.block=None
+        self.block_i0=0
+
+    def load(self,keys):
+        """
+        read one block that covers all pulses starting at sample indices keys
+        """
+        self.block=None
+        if len(keys) == 0:
+            return
+        self.block_i0=int(n.min(keys))
+        block_len=int(n.max(keys))+self.read_len-self.block_i0
+        try:
+            self.block=self.d_il.read_vector_c81d(self.block_i0, block_len, self.channel)
+            self.block-=self.z_dc
+        except:
+            print("couldn't read %d samples in one block. reading one pulse at a time"%(block_len))
+            self.block=None
+
+    def read(self,key):
+        if self.block is not None:
+            i=int(key)-self.block_i0
+            if (i >= 0) and ((i+self.read_len) <= len(self.block)):
+                return(self.block[i:(i+self.read_len)])
+
+        if key in self.cache.keys():
+            self.cache.move_to_end(key)
+            return(self.cache[key])
+
+        z=self.d_il.read_vector_c81d(key, self.read_len, self.channel) - self.z_dc
+        self.cache[key]=z
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return(z)
+
+class fft_filter_bank:
+    """
+    the fft_lpf low pass filter with an optional set of notch bands, applied to a batch
+    of pulses (rows of a 2d array) with pre-planned FFTW transforms on aligned arrays.
+
+    the filter response, the notches and the circular shift that centers the filter
+    are combined into one frequency domain multiply, so notching RFI costs nothing extra.
+    notch_freq_range is a list of [f0, f1] frequency ranges (Hz) to remove.
+    """
+    def __init__(self,z_len=10000,sr=1e6,f0=1.2*0.1e6,L=20,notch_freq_range=[],threads=1):
+        self.z_len=z_len
+        self.threads=threads
+        lpf=fft_lpf(z_len,sr=sr,f0=f0,L=L)
+        # n.roll(z,-L) in frequency domain
+        H=lpf.H*n.exp(2j*n.pi*n.arange(z_len)*L/z_len)
+
+        z_fftfreq=n.fft.fftfreq(z_len,d=1/sr)
+        for freq_range in notch_freq_range:
+            fridx0=n.argmin(n.abs(z_fftfreq-freq_range[0]))
+            fridx1=n.argmin(n.abs(z_fftfreq-freq_range[1]))
+            H[fridx0:fridx1]=0.0
+        self.H=n.array(H,dtype=n.complex64)
+        self.plans={}
+
+    def plan(self,n_rows):
+        """
+        forward and backward transforms for n_rows pulses, planned once
+        """
+        if n_rows not in self.plans.keys():
+            a=pyfftw.empty_aligned((n_rows,self.z_len),dtype=n.complex64)
+            b=pyfftw.empty_aligned((n_rows,self.z_len),dtype=n.complex64)
+            fwd=pyfftw.FFTW(a,b,axes=(1,),direction="FFTW_FORWARD",flags=("FFTW_MEASURE",),threads=self.threads)
+            bwd=pyfftw.FFTW(b,a,axes=(1,),direction="FFTW_BACKWARD",flags=("FFTW_MEASURE",),threads=self.threads)
+            self.plans[n_rows]=(a,b,fwd,bwd)
+        return(self.plans[n_rows])
+
+    def filter(self,z):
+        """
+        filter all rows of z. returns a new array
+        """
+        a,b,fwd,bwd=self.plan(z.shape[0])
+        a[:,:]=z
+        fwd()
+        b*=self.H
+        bwd()
+        return(n.copy(a))
+
 def ideal_lpf_h(sr=1e6,f0=1.2*0.1e6,L=200):
     m=n.arange(-L,L)+1e-6
     om0=n.pi*f0/(0.5*sr)
@@ -123,6 +274,42 @@ def estimate_dc(d_il,tmm,sid,channel):
     return(z_dc)
     
 
+class product_writer:
+    """
+    store the decimated lagged products of the echoes and the transmit pulse of each pulse in
+    an integration window. one pulse per chunk, compressed. lpi_files(use_products=True) redoes
+    the outlier rejection and the inversion from these, without reading and filtering the raw voltage.
+    """
+    def __init__(self,fname):
+        self.ho=h5py.File(fname,"w")
+        self.keys=[]
+
+    def add(self,key,ambs,measgs,meases):
+        n_p=len(self.keys)
+        for name,x in [("ambs",ambs),("measgs",measgs),("meases",meases)]:
+            if n_p == 0:
+                self.ho.create_dataset(name,shape=(0,)+x.shape,maxshape=(None,)+x.shape,chunks=(1,)+x.shape,
+                                       dtype=n.complex64,compression="gzip")
+            self.ho[name].resize(n_p+1,axis=0)
+            self.ho[name][n_p]=x
+        self.keys.append(key)
+
+    def close(self,info):
+        """
+        store the pulse times and the window information (dict of arrays or scalars)
+        """
+        self.ho["keys"]=n.array(self.keys,dtype=n.int64)
+        for k in info.keys():
+            self.ho[k]=info[k]
+        self.ho.close()
+
+def convolution_index(L, rmin=0, rmax=100):
+    """
+    index matrix idxm[i,j] = (i - ridx[j]) % L, built without a python loop
+    """
+    ridx = n.arange(rmin, rmax,dtype=int)
+    return(n.mod(n.arange(L,dtype=int)[:,None] - ridx[None,:], L))
+
 def convolution_matrix(envelope, rmin=0, rmax=100):
     """
     we imply that the number of measurements is equal to the number of elements
@@ -133,30 +320,532 @@ def convolution_matrix(envelope, rmin=0, rmax=100):
     """
     L = len(envelope)
     ridx = n.arange(rmin, rmax,dtype=int)
-    A = n.zeros([L, rmax - rmin], dtype=n.complex64)
-    idxm = n.zeros([L, rmax - rmin], dtype=int)    
-    for i in n.arange(L):
-        A[i, :] = envelope[(i - ridx) % L]
-        idxm[i,:] = n.array(n.mod( i-ridx, L ),dtype=int)
+    idxm = convolution_index(L, rmin, rmax)
+    A = n.array(envelope[idxm], dtype=n.complex64)
     result = {}
     result["A"] = A
     result["ridx"] = ridx
     result["idxm"] = idxm
     return(result)
 
+# sparse theory matrix plans, keyed by (m1, rmin, rmax, m0, s0, s1). these only depend on the range
+# gating and the transmit pulse, which are fixed for a run, so they are shared by all integration windows.
+theory_plans = {}
+
+def load_convolution_plans(fname):
+    """
+    read theory matrix plans stored with save_convolution_plans into the cache
+    """
+    if not os.path.exists(fname):
+        return
+    h=h5py.File(fname,"r")
+    if "theory" in h.keys():
+        for tk in h["theory"].keys():
+            key=tuple([int(x) for x in tk.split("_")])
+            g=h["theory"][tk]
+            theory_plans[key]={"q":n.copy(g["q"][()]),"indices":n.copy(g["indices"][()]),"indptr":n.copy(g["indptr"][()])}
+    h.close()
+
+def save_convolution_plans(fname):
+    """
+    store all cached theory matrix plans
+    """
+    ho=h5py.File(fname,"a")
+    g=ho.require_group("theory")
+    for key in theory_plans.keys():
+        k="%d_%d_%d_%d_%d_%d"%key
+        if k not in g.keys():
+            tg=g.create_group(k)
+            for d in ["q","indices","indptr"]:
+                tg.create_dataset(d,data=theory_plans[key][d],compression="gzip")
+    ho.close()
+
+def theory_plan(s0,s1,rmin,rmax,m0,m1):
+    """
+    csc structure of the theory matrix for an ambiguity function that is nonzero at
+    decimated indices s0 <= q < s1. q holds the ambiguity index of each nonzero element.
+    cached, as it only depends on the range gating and the transmit pulse.
+    """
+    key=(int(m1),int(rmin),int(rmax),int(m0),int(s0),int(s1))
+    if key in theory_plans.keys():
+        return(theory_plans[key])
+
+    n_meas=m1-m0
+    support=n.arange(s0,s1,dtype=int)
+    ridx=n.arange(rmin,rmax,dtype=int)
+    # column j has amb[q] on row (ridx[j]+q) % m1
+    rows=n.mod(ridx[:,None]+support[None,:],m1)
+    q=n.repeat(support[None,:],len(ridx),axis=0)
+    if len(support) > 0 and (rmax-1+support[-1]) >= m1:
+        # wrap around. csc needs sorted row indices within each column
+        order=n.argsort(rows,axis=1)
+        rows=n.take_along_axis(rows,order,axis=1)
+        q=n.take_along_axis(q,order,axis=1)
+    valid=rows >= m0
+    counts=n.sum(valid,axis=1)
+
+    indptr=n.zeros(len(ridx)+2,dtype=n.int64)
+    indptr[1:(len(ridx)+1)]=n.cumsum(counts)
+    indptr[len(ridx)+1]=indptr[len(ridx)]+n_meas
+    # the last column is the range independent noise process
+    indices=n.concatenate([rows[valid]-m0,n.arange(n_meas)])
+    theory_plans[key]={"q":q[valid],"indices":indices,"indptr":indptr}
+    return(theory_plans[key])
+
+def theory_matrix(amb,rmin,rmax,m0,m1):
+    """
+    sparse theory matrix for one pulse and lag, written directly in csc format from
+    the nonzero part of the decimated ambiguity function amb. the same as
+
+    TM=n.hstack([amb[convolution_index(m1,rmin,rmax)],n.ones([m1,1])])
+    sparse.csc_matrix(TM[m0:m1,:])
+
+    without the dense allocation and conversion.
+    """
+    n_meas=m1-m0
+    # the nonzero part of the ambiguity function is about one pulse length long
+    nz=n.where(amb[0:m1] != 0)[0]
+    s0=0
+    s1=0
+    if len(nz) > 0:
+        s0=nz[0]
+        s1=nz[-1]+1
+    plan=theory_plan(s0,s1,rmin,rmax,m0,m1)
+    data=n.concatenate([amb[plan["q"]],n.ones(n_meas,dtype=amb.dtype)])
+    return(sparse.csc_matrix((data,plan["indices"],plan["indptr"]),shape=(n_meas,rmax-rmin+1)))
+
+def partition_percentile(x,q,axis=0):
+    """
+    the same as n.percentile(x,q,axis=axis) with linear interpolation, but with a partial
+    sort (n.partition) instead of a full one. columns containing nans give nan.
+    """
+    N=x.shape[axis]
+    pos=(q/100.0)*(N-1)
+    lo=int(n.floor(pos))
+    hi=min(lo+1,N-1)
+    frac=pos-lo
+    xp=n.partition(x,[lo,hi],axis=axis)
+    x_lo=n.take(xp,lo,axis=axis)
+    x_hi=n.take(xp,hi,axis=axis)
+    res=x_lo+frac*(x_hi-x_lo)
+    res[n.any(n.isnan(x),axis=axis)]=n.nan
+    return(res)
+
+def batched_outlier_statistics(pwr_e,pwr_g):
+    """
+    robust statistics for the lagged product ratio test, for all lags at once.
+    pwr_e and pwr_g are (n_lags, n_ipp, n_meas) arrays of |m|^2 without and with ground clutter removal.
+
+    returns the (n_lags, n_meas) standard deviations estimated from the 34th percentile,
+    the (n_lags, n_ipp, n_meas) standard deviation smoothed over 10 pulses, and its median for each lag.
+    """
+    sigma_lp_est=n.sqrt(partition_percentile(pwr_e,34,axis=1)*2.0)
+    sigma_lp_est_g=n.sqrt(partition_percentile(pwr_g,34,axis=1)*2.0)
+
+    n_ipp=pwr_e.shape[1]
+    wf=n.repeat(1/10,10)
+    WF=fft(wf,n_ipp)
+    WF.shape=(1,n_ipp,1)
+    # we need to wrap around, to avoid too low values.
+    localized_sigma=n.array(n.roll(n.sqrt(ifft(WF*fft(pwr_e,axis=1),axis=1).real),-5,axis=1),dtype=pwr_e.dtype)
+
+    # make sure we don't have a division by zero
+    msig=n.nanmedian(localized_sigma.reshape((localized_sigma.shape[0],-1)),axis=1)
+    msig[msig<0]=1.0
+    for li in range(len(msig)):
+        localized_sigma[li][localized_sigma[li]<msig[li]]=msig[li]
+    return(sigma_lp_est,sigma_lp_est_g,localized_sigma,msig)
+
+def outlier_statistics(pwr_e,pwr_g):
+    """
+    robust statistics for the lagged product ratio test for one lag.
+    pwr_e and pwr_g are (n_ipp, n_meas) arrays of |m|^2 without and with ground clutter removal.
+    """
+    sigma_lp_est,sigma_lp_est_g,localized_sigma,msig=batched_outlier_statistics(pwr_e[None,:,:],pwr_g[None,:,:])
+    return(sigma_lp_est[0],sigma_lp_est_g[0],localized_sigma[0],msig[0])
+
+def reject_outliers(m_e,m_g,sigma_lp_est,sigma_lp_est_g,localized_sigma,msig,ratio_threshold=10.0,sigma_threshold=100.0):
+    """
+    set outlier lagged products to nan, in place. works on a (n_ipp, n_meas) array of
+    lagged products, or on a single row together with the corresponding row of localized_sigma.
+    the statistics broadcast, so (n_lags, n_ipp, n_meas) arrays work too.
+    m_g can cover fewer delays than m_e, starting from the same delay.
+    """
+    n_g=m_g.shape[-1]
+    ratio_test=n.abs(m_e)/sigma_lp_est
+    ratio_test_g=n.abs(m_g)/sigma_lp_est_g
+
+    # is this threshold too high?
+    # maybe 6-7 might still be possible.
+    m_e[ratio_test > ratio_threshold]=n.nan
+    m_g[ratio_test_g > ratio_threshold]=n.nan
+
+    # these will be shit no matter what
+    m_e[localized_sigma > sigma_threshold*msig]=n.nan
+    m_g[localized_sigma[...,0:n_g] > sigma_threshold*msig]=n.nan
+
+def ratio_test_lags(gst,ratio_threshold=10.0,sigma_threshold=100.0):
+    """
+    ratio test for all lags in memory at once, on (n_lags, n_ipp, n_meas) arrays, for the list based
+    inversion. returns the lagged products with the outliers set to nan, and their standard deviation
+    """
+    if len(gst["mes"][0]) < 16:
+        return(None,None,None)
+    # tbd: estimate the fourth moments for lagged products
+    #
+    # <(m_t m_{t+\tau}^*) (m_t^* m_{t+\tau})>
+    # but also for this one:
+    # <(m_t m_{t+\tau}^*) (m_t m_{t+\tau}^*)>
+    # as it might not be zero when snr is high!!!
+    # this would require doing the least-squares with
+    # a slightly different method
+    #
+    print("ratio test")
+    mm_ea=n.array(gst["mes"])
+    mm_ga=n.array(gst["mgs"])
+    gst["mes"]=None
+    gst["mgs"]=None
+    sigma_lp_est,sigma_lp_est_g,localized_sigma,msig=batched_outlier_statistics(n.abs(mm_ea)**2.0,n.abs(mm_ga)**2.0)
+    reject_outliers(mm_ea,mm_ga,sigma_lp_est[:,None,:],sigma_lp_est_g[:,None,:],localized_sigma,msig[:,None,None],ratio_threshold,sigma_threshold)
+    return(mm_ea,mm_ga,localized_sigma)
+
+def normal_equations(n_par):
+    """
+    running sums A^H Sigma^{-1} A and A^H Sigma^{-1} m for one lag
+    """
+    ne={"ATA":n.zeros([n_par,n_par],dtype=n.complex128),
+        "ATm_e":n.zeros(n_par,dtype=n.complex128),
+        "ATm_g":n.zeros(n_par,dtype=n.complex128),
+        "n_good":0,
+        "n_meas":0}
+    return(ne)
+
+def accumulate_normal_equations(ne,TM,m_e,m_g,sigma):
+    """
+    add the measurements of one pulse to the normal equations. 
+    TM is the sparse theory matrix, m_e and m_g the lagged products without and with ground 
+    clutter removal and sigma their standard deviation. rows where anything is nan are skipped.
+    either m_e or m_g can be None, to only accumulate the other one.
+    """
+    good=(n.isnan(sigma) == False)
+    if m_e is not None:
+        good=good & (n.isnan(m_e) == False)
+    if m_g is not None:
+        good=good & (n.isnan(m_g) == False)
+    gidx = n.where(good)[0]
+    ne["n_meas"]+=len(sigma)
+    ne["n_good"]+=len(gidx)
+    if len(gidx) == 0:
+        return
+
+    TM=TM[gidx,:]
+    # A^H \Sigma^{-1}
+    AT=sparse.csr_matrix(n.conj(TM.T).multiply(1.0/sigma[gidx]**2.0))
+    ATA=AT.dot(TM).tocoo()
+    ne["ATA"][ATA.row,ATA.col]+=ATA.data
+    if m_e is not None:
+        ne["ATm_e"]+=AT.dot(m_e[gidx])
+    if m_g is not None:
+        ne["ATm_g"]+=AT.dot(m_g[gidx])
+
+def joint_normal_equations(nes,scales=None):
+    """
+    normal equations of several receivers, which measure the same volume with the same transmitted
+    pulses. the acf parameters are shared and each receiver has its own noise parameter (the last one
+    of each ne), so there are len(nes) noise parameters at the end.
+
+    the lagged products of receiver k are multiplied by scales[k], to put all receivers into the same units
+    """
+    n_x=nes[0]["ATA"].shape[0]-1
+    ne=normal_equations(n_x+len(nes))
+    for k,ne_k in enumerate(nes):
+        s=1.0
+        if scales is not None:
+            s=scales[k]
+        idx=n.concatenate([n.arange(n_x),[n_x+k]])
+        ne["ATA"][n.ix_(idx,idx)]+=ne_k["ATA"]/s**2.0
+        ne["ATm_e"][idx]+=ne_k["ATm_e"]/s
+        ne["ATm_g"][idx]+=ne_k["ATm_g"]/s
+        ne["n_good"]+=ne_k["n_good"]
+        ne["n_meas"]+=ne_k["n_meas"]
+    return(ne)
+
+def add_normal_equations(ne,ne_sub,sign=1):
+    """
+    add (sign=1) or subtract (sign=-1) the normal equations ne_sub to ne, in place
+    """
+    ne["ATA"]+=sign*ne_sub["ATA"]
+    ne["ATm_e"]+=sign*ne_sub["ATm_e"]
+    ne["ATm_g"]+=sign*ne_sub["ATm_g"]
+    ne["n_good"]+=sign*ne_sub["n_good"]
+    ne["n_meas"]+=sign*ne_sub["n_meas"]
+
+class sliding_normal_equations:
+    """
+    normal equations and measurement counts of a sliding integration window, made of the
+    last n_sub sub-windows. the running sums are updated by adding the newest sub-window
+    and subtracting the one that dropped out of the window.
+
+    a sub-window is a dict with "i0", "stats", "pwr_spec" and "gate_state", a list with
+    the "ne", "outlier_stats", "ok_count" and "meas_count" of each range gate size, and
+    "ne_g" if the ground clutter removed estimate is solved separately.
+    """
+    def __init__(self,n_sub):
+        self.n_sub=n_sub
+        self.subs=collections.deque()
+        self.total=None
+
+    def add_sub(self,sub,sign):
+        for gi,gst in enumerate(sub["gate_state"]):
+            tot=self.total["gate_state"][gi]
+            for li in range(len(gst["ne"])):
+                add_normal_equations(tot["ne"][li],gst["ne"][li],sign)
+                if "ne_g" in gst.keys():
+                    add_normal_equations(tot["ne_g"][li],gst["ne_g"][li],sign)
+            tot["ok_count"]+=sign*gst["ok_count"]
+            tot["meas_count"]+=sign*gst["meas_count"]
+        self.total["pwr_spec"]+=sign*sub["pwr_spec"]
+
+    def add(self,si,sub):
+        """
+        add sub-window number si. returns True when the window holds n_sub consecutive sub-windows
+        """
+        if len(self.subs) > 0 and si != self.subs[-1][0]+1:
+            # not contiguous, start over
+            self.subs.clear()
+            self.total=None
+
+        if self.total is None:
+            self.total={"pwr_spec":n.zeros(len(sub["pwr_spec"])),"gate_state":[]}
+            for gst in sub["gate_state"]:
+                tot={"ne":[],
+                     "ok_count":n.zeros(len(gst["ok_count"]),dtype=int),
+                     "meas_count":n.zeros(len(gst["meas_count"]),dtype=int)}
+                for li in range(len(gst["ne"])):
+                    tot["ne"].append(normal_equations(gst["ne"][li]["ATA"].shape[0]))
+                if "ne_g" in gst.keys():
+                    tot["ne_g"]=[]
+                    for li in range(len(gst["ne_g"])):
+                        tot["ne_g"].append(normal_equations(gst["ne_g"][li]["ATA"].shape[0]))
+                self.total["gate_state"].append(tot)
+        self.add_sub(sub,1)
+        self.subs.append((si,sub))
+
+        if len(self.subs) > self.n_sub:
+            si_old,sub_old=self.subs.popleft()
+            self.add_sub(sub_old,-1)
+        return(len(self.subs) == self.n_sub)
+
+    def window(self):
+        """
+        start time, gate_state, noise statistics and power spectrum of the sliding window
+        """
+        stats={"bg_samples":[],
+               "bg_plus_inj_samples":[],
+               "z_dc_samples":[],
+               "avg_pwr":0.0,
+               "avg_pwr_n":0,
+               "n_pwr_spec":0.0,
+               "n_prescreen":0,
+               "n_prescreen_clipped":0,
+               "n_prescreen_peak":0,
+               "n_prescreen_noise":0}
+        for si,sub in self.subs:
+            for k in stats.keys():
+                stats[k]+=sub["stats"][k]
+
+        # the ratio test is done for each sub-window. a lag is solved if any sub-window had enough measurements
+        for gi,tot in enumerate(self.total["gate_state"]):
+            tot["outlier_stats"]=[None]*len(tot["ne"])
+            for si,sub in self.subs:
+                for li,ost in enumerate(sub["gate_state"][gi]["outlier_stats"]):
+                    if ost is not None:
+                        tot["outlier_stats"][li]=ost
+        return(self.subs[0][1]["i0"],self.total["gate_state"],stats,self.total["pwr_spec"])
+
+def estimate_lpi_memory(n_pulses,n_lags,lag_avg,gates,tx_len,streaming=False):
+    """
+    rough estimate of the peak memory use (bytes) of one integration window of one channel.
+    returns the part that grows with the number of lags held in memory at once (bytes per lag)
+    and the part that doesn't (the solve of one lag).
+    """
+    per_lag=0
+    fixed=0
+    n_rows=n_pulses*lag_avg
+    for gate in gates:
+        n_meas=gate["n_meas"]
+        n_par=gate["rmax"]-min(gate["rmins"])+1
+        # one theory matrix. each range gate is measured by about one pulse length of lagged products
+        n_tx=int(n.ceil(tx_len/gate["rdec"]))+1
+        tm_bytes=12*(n_tx*n_par+n_meas)+4*(n_par+2)
+        if streaming:
+            # power of the lagged products, the ratio test statistics and the normal equations
+            per_lag+=3*4*n_rows*n_meas+16*n_par**2
+            fixed=max(fixed,4*tm_bytes)
+        else:
+            # lagged products, theory matrices and the ratio test arrays
+            per_lag+=n_rows*(2*8*n_meas+3*4*n_meas+tm_bytes)
+            # the stacked theory matrix and the dense matrices of one lag
+            fixed=max(fixed,n_rows*tm_bytes+3*16*n_par**2)
+    return(per_lag,fixed)
+
+def banded_selected_inversion(U):
+    """
+    diagonal of B^{-1}, where B = U^H U and U is the upper triangular banded cholesky factor
+    in the storage format of scipy.linalg.cholesky_banded.
+
+    uses the Takahashi recursion U Z = U^{-H}, which only needs the elements of Z = B^{-1}
+    inside the band. O(n b^2) instead of O(n^3) for a full inverse.
+    """
+    bw=U.shape[0]-1
+    nb=U.shape[1]
+    # Z[i,j] is only evaluated for |i-j| <= bw, so it is kept in the same upper banded
+    # storage as U, Zb[bw+i-j,j] = Z[i,j] for j >= i, and Z[j,i] = conj(Z[i,j])
+    Zb=n.zeros([bw+1,nb],dtype=U.dtype)
+    # indices of a bw x bw block of Z around the diagonal in the band storage
+    r,c=n.meshgrid(n.arange(bw),n.arange(bw),indexing="ij")
+    upper=c >= r
+    for i in range(nb-1,-1,-1):
+        uii=U[bw,i].real
+        k1=n.min([nb,i+bw+1])
+        if k1 > i+1:
+            m=k1-i-1
+            cols=n.arange(i+1,k1)
+            # U[i,i+1:k1]
+            ui=U[bw-n.arange(1,m+1),cols]
+            # Z[i+1:k1,i+1:k1]
+            rb=r[0:m,0:m]
+            cb=c[0:m,0:m]
+            ub=upper[0:m,0:m]
+            Zblock=n.where(ub,
+                           Zb[bw-n.abs(cb-rb),i+1+n.maximum(rb,cb)],
+                           n.conj(Zb[bw-n.abs(cb-rb),i+1+n.maximum(rb,cb)]))
+            zrow=-n.dot(ui,Zblock)/uii
+            Zb[bw-n.arange(1,m+1),cols]=zrow
+            Zb[bw,i]=(1.0/uii - n.dot(ui,n.conj(zrow)))/uii
+        else:
+            Zb[bw,i]=1.0/uii**2.0
+    return(Zb[bw,:].real)
+
+def solve_banded_normal_equations(ATA,ATm_e,ATm_g,n_noise=1):
+    """
+    solve the normal equations using the structure of the Fisher information matrix.
+    the range gates only couple within the length of the transmit pulse, so the range block is
+    banded, and the noise columns (one per receiver) add dense rows and columns (an arrow matrix).
+
+    [[B, c], [c^H, d]] is solved with a banded cholesky factorization of B and the
+    Schur complement of d. the variances come from a selected inversion of B.
+    """
+    # the list mode gives single precision sums, which is not enough for a cholesky factorization
+    ATA=n.array(ATA,dtype=n.complex128)
+    nr=ATA.shape[0]-n_noise
+    B=ATA[0:nr,0:nr]
+    c=ATA[0:nr,nr:]
+    d=ATA[nr:,nr:]
+
+    ii,jj=n.nonzero(B)
+    if len(ii) == 0:
+        # no measurements of the range gates
+        return(solve_normal_equations(ATA,ATm_e,ATm_g,n_noise=n_noise))
+    bw=int(n.max(n.abs(ii-jj)))
+    if bw > nr/4:
+        # not banded enough to be worth it
+        return(solve_normal_equations(ATA,ATm_e,ATm_g,n_noise=n_noise))
+
+    # upper banded storage ab[bw+i-j,j] = B[i,j]
+    ab=n.zeros([bw+1,nr],dtype=ATA.dtype)
+    for k in range(bw+1):
+        ab[bw-k,k:nr]=n.diag(B,k)
+    U=sla.cholesky_banded(ab,lower=False)
+
+    u=sla.cho_solve_banded((U,False),c)
+    # Schur complement of the noise parameters
+    schur_inv=n.linalg.inv(d-n.dot(n.conj(c.T),u))
+
+    xhats=[]
+    for ATm in [ATm_e,ATm_g]:
+        y=sla.cho_solve_banded((U,False),ATm[0:nr])
+        xn=n.dot(schur_inv,ATm[nr:]-n.dot(n.conj(c.T),y))
+        xhats.append(n.concatenate([y-n.dot(u,xn),xn]))
+
+    # diag of the inverse of the arrow matrix
+    xhat_var=n.zeros(nr+n_noise)
+    xhat_var[0:nr]=banded_selected_inversion(U)+n.sum(n.dot(u,schur_inv)*n.conj(u),axis=1).real
+    xhat_var[nr:]=n.diag(schur_inv).real
+    return(xhats[0],xhats[1],xhat_var)
+
+def solve_cg_normal_equations(ATA,ATm_e,ATm_g,x0=None,var0=None,diag=None,n_probe=16,rtol=1e-6):
+    """
+    solve the normal equations with the conjugate gradient method. ATA only needs to support
+    matrix-vector products, so it can be a LinearOperator that never forms A^H Sigma^{-1} A.
+    diag is the diagonal of ATA, used as a Jacobi preconditioner.
+
+    x0=(xhat_e,xhat_g) is a starting point, e.g., the estimate of the previous integration
+    window for the same lag, which is nearly the same.
+
+    the variances are estimated with Hutchinson's stochastic diagonal estimator
+    diag(Sigma) = E[v * Sigma v] for random +/-1 vectors v, averaged over n_probe vectors.
+    each Sigma v is a solve that starts from var0*v, the previous variance estimate.
+    the relative error of the variances goes down as 1/sqrt(n_probe).
+    """
+    n_par=ATA.shape[0]
+    ATA=spla.aslinearoperator(ATA)
+    M=None
+    if diag is not None:
+        M=spla.LinearOperator((n_par,n_par),matvec=lambda x: x/diag,dtype=n.complex128)
+
+    def cg(b,xs):
+        x,info=spla.cg(ATA,n.array(b,dtype=n.complex128),x0=xs,rtol=rtol,maxiter=10*n_par,M=M)
+        if info > 0:
+            print("cg did not converge")
+        return(x)
+
+    if x0 is None:
+        x0=(None,None)
+    xhat_e=cg(ATm_e,x0[0])
+    xhat_g=cg(ATm_g,x0[1])
+
+    xhat_var=n.zeros(n_par)
+    for pi in range(n_probe):
+        v=n.array(2*n.random.randint(0,2,size=n_par)-1,dtype=n.complex128)
+        vs=None
+        if var0 is not None:
+            vs=var0*v
+        xhat_var+=(n.conj(v)*cg(v,vs)).real
+    xhat_var=xhat_var/n_probe
+    return(xhat_e,xhat_g,xhat_var)
+
+def solve_normal_equations(ATA,ATm_e,ATm_g,solver="inv",n_noise=1):
+    """
+    ML estimates without and with ground clutter removal, and their variances
+
+    solver="inv" uses a full inverse, solver="banded" uses solve_banded_normal_equations.
+    n_noise is the number of noise parameters, which are the last ones
+    """
+    if solver == "banded":
+        return(solve_banded_normal_equations(ATA,ATm_e,ATm_g,n_noise=n_noise))
+
+    # error covariance
+    Sigma=n.linalg.inv(ATA)
+
+    # ML estimate for ACF lag without ground clutter mitigation measures in place
+    xhat_e=n.dot(Sigma,ATm_e)
+
+    # ML estimate for ACF lag with ground clutter mitigation measures
+    xhat_g=n.dot(Sigma,ATm_g)
+    return(xhat_e,xhat_g,n.diag(Sigma.real))
+
 tmm = {}
 T_injection=1172.0 # May 24th 2022 value
 tmm[300]={"noise0":7800,"noise1":8371,"tx0":76,"tx1":645,"gc":1000,"last_echo":7700,"e_gc":800}
 for i in range(1,33):
     tmm[i]={"noise0":8400,"noise1":8850,"tx0":76,"tx1":624,"gc":1000,"last_echo":8200,"e_gc":800}
 
-#
-# tbd: add range gates of different sizes
-#
 def lpi_files(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1bc13/isr/2023-09-05/usrp-rx0-r_20230905T214448_20230906T040054",
               avg_dur=10,  # n seconds to average
-              channel="zenith-l",
-              rg=60,       # how many microseconds is one range gate
+              step=None,   # n seconds between the start of consecutive integration windows, a whole number if different from avg_dur. None is avg_dur
+              channel="zenith-l",          # one channel, or a list of channels that are analyzed in one pass over the data
+              rg=60,       # how many microseconds is one range gate. a list of range gates is analyzed in one pass
               min_tx_frac=0.5,  # how much of the pulse can be missing due to ground clutter clipping, defines the minimum range gate
               reanalyze=False,
               pass_band=0.1e6,
@@ -167,10 +856,65 @@ def lpi_files(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1bc13/isr/2023-09
               min_tx_pwr=400e3,
               fft_len=1024,                 # store diagnostic spectrum for RFI identification
               lags=n.arange(1,46,dtype=int)*10,
-              lag_avg=1
+              lag_avg=1,
+              streaming=False,             # two passes over the pulses, accumulating the normal equations instead of storing theory matrices
+              plan_file=None,              # optional h5 file for persisting the theory matrix index plans between runs
+              solver="inv",                # "inv" full inverse, "banded" banded cholesky and selected inversion, "cg" warm started conjugate gradient
+              n_probe=16,                  # number of random probe vectors for the variance estimate of the "cg" solver
+              prefetch=True,               # read the next integration window in a background thread
+              notch_freq_range=[],         # list of [f0,f1] (Hz) RFI frequency bands to notch out
+              early_dec=1,                 # decimate the filtered echoes by this much before lagged products. "auto" picks the largest possible
+              tx_cache_corr=None,          # reuse the transmit pulse lagged products of a code while the normalized correlation of the transmit pulse stays above this (e.g., 0.999). None disables
+              save_products=False,         # store the lagged products of each pulse in lpi_products/<channel>
+              use_products=False,          # redo the outlier rejection and inversion from stored lagged products, instead of the raw voltage
+              ratio_threshold=10.0,        # lagged products this many standard deviations away are outliers
+              sigma_threshold=100.0,       # lagged products with a localized standard deviation this many times the median are outliers
+              postfix="",                  # results are stored in lpi_<rg><postfix>/<channel>
+              gc_max_delay=None,           # microseconds. only estimate the ground clutter removed acfs_g below this delay, with a separate smaller inversion
+              prescreen=False,             # reject pulses with clipping, bright peaks or high noise before the lagged products are calculated. the thresholds are not yet tuned with real data
+              max_noise_ratio=4.0,         # pre-screen. background noise power relative to the median of the previous good pulses
+              max_peak_ratio=1000.0,       # pre-screen. peak to median power of the ground clutter subtracted echo in each range block
+              clip_level=32000.0,          # pre-screen. samples with |re| or |im| at least this are clipped
+              max_clipped=10,              # pre-screen. maximum number of clipped echo samples
+              memory_budget=None,          # bytes per rank. lags are processed in chunks, with one pass over the pulses each, to stay below this
+              joint=False,                 # one inversion with all channels (e.g., zenith-l and zenith-l2), with a noise parameter for each channel
+              save_channels=True           # with joint=True, also store the results of each channel
               ):
 
-    os.system("mkdir -p %s/lpi_%d/%s"%(dirname,rg,channel))
+    # the pulse schedule and the transmitter state is shared by all channels
+    if isinstance(channel,str):
+        channels=[channel]
+    else:
+        channels=list(channel)
+    # the lagged products are calculated once with the finest range gate.
+    # coarser range gates are sums of neighbouring range gates
+    if n.isscalar(rg):
+        range_gates=[int(rg)]
+    else:
+        range_gates=sorted([int(r) for r in rg])
+    rg0=range_gates[0]
+    for r in range_gates:
+        if r % rg0 != 0:
+            raise ValueError("range gate %d is not a multiple of the finest range gate %d"%(r,rg0))
+    # the joint analysis of all channels is stored as channel <ch0>+<ch1>+...
+    joint_channel=None
+    if joint:
+        if len(channels) < 2:
+            raise ValueError("the joint analysis needs more than one channel")
+        joint_channel="+".join(channels)
+        for r in range_gates:
+            os.system("mkdir -p %s/lpi_%d%s/%s"%(dirname,r,postfix,joint_channel))
+    for channel in channels:
+        for r in range_gates:
+            os.system("mkdir -p %s/lpi_%d%s/%s"%(dirname,r,postfix,channel))
+        if save_products:
+            os.system("mkdir -p %s/lpi_products/%s"%(dirname,channel))
+
+    def products_fname(channel,i0):
+        """
+        file with the stored lagged products of integration window i0
+        """
+        return("%s/lpi_products/%s/products-%d.h5"%(dirname,channel,int(i0/1e6)))
         
     id_read = DigitalMetadataReader("%s/metadata/id_metadata"%(dirname))
     d_il = DigitalRFReader("%s/rf_data/"%(dirname))
@@ -188,8 +932,29 @@ def lpi_files(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1bc13/isr/2023-09
     use_ideal_filter=True
     debug_gc_rem=False
 
+    # overlapping integration windows are sums of step long sub-windows
+    if step is None:
+        step=avg_dur
+    sliding = (step != avg_dur)
+    n_sub=int(n.round(avg_dur/step))
+    if n.abs(n_sub*step-avg_dur) > 1e-6:
+        raise ValueError("avg_dur=%1.2f needs to be a multiple of step=%1.2f"%(avg_dur,step))
+    if sliding and n.abs(step-n.round(step)) > 1e-6:
+        # the output files are named after the start of the window in whole seconds
+        raise ValueError("overlapping integration windows need a whole number of seconds for step=%1.2f"%(step))
+    if sliding and use_products:
+        raise ValueError("overlapping integration windows can't be used with stored lagged products")
+    if sliding and (streaming == False):
+        # sub-windows are combined through their normal equations
+        print("overlapping integration windows use streaming mode")
+        streaming=True
+    if joint and (streaming == False):
+        # the channels are combined through their normal equations
+        print("joint analysis of the channels uses streaming mode")
+        streaming=True
+
     # how many integration cycles do we have
-    n_times = int(n.floor((idb[1]-idb[0])/idsr/avg_dur))
+    n_times = int(n.floor(((idb[1]-idb[0])/idsr-avg_dur)/step))+1
 
     # which lags to calculate
     
@@ -202,540 +967,1117 @@ def lpi_files(dirname="/media/j/fee7388b-a51d-4e10-86e3-5cabb0e1bc13/isr/2023-09
     for i in range(n_lags):
         mean_lags[i]=n.mean(lags[i:(i+lag_avg)])
 
-    # maximum number of microseconds of delay, which we analyze
-    # this is experiment specific. need to read from configuration eventually
-    
-    n_rg=int(n.floor(maximum_range_delay/rg))
-    rgs=n.arange(n_rg)*rg
-    rmax=n_rg
-
     # round trip speed of light in vacuum propagation, one microsecond
     rg_1us=c.c/1e6/2.0/1e3
 
-    # range gates
-    rgs_km=rgs*rg_1us
-
     # first entry in tx pulse metadata
     i0=idb[0]
 
-    lpf=fft_lpf(10000,f0=1.2*pass_band,L=filter_len)
-
-    decim=simple_decimator(L=10000,dec=rg)
+    lpf=fft_filter_bank(10000,f0=1.2*pass_band,L=filter_len,notch_freq_range=notch_freq_range)
 
     pwr_spec=n.zeros(fft_len,dtype=n.float32)
     n_pwr_spec=0.0
     spec_window=ss.windows.hann(fft_len)
 
-    
-
-    # go through one integration window at a time
-    for ai in range(rank,n_times,size):
-
-        
-        i0 = ai*int(avg_dur*idsr) + idb[0]
-
-        if os.path.exists("%s/lpi_%d/%s/lpi-%d.png"%(dirname,rg,channel,int(i0/1e6))) and reanalyze==False:
-            print("already analyzed %d"%(i0/1e6))
-            continue
-
-        # get info on all the pulses transmitted during this averaging interval
-        # get some extra for gc
-        sid = id_read.read(i0,i0+int(avg_dur*idsr)+40000,"sweepid")
-
-        n_pulses=len(sid.keys())
+    sample0=800
+    sample1=8200
+    # range decimation of the lagged products
+    rdec0=rg0
+
+    # the longest transmit pulse
+    tx_max=0
+    for k in tmm.keys():
+        tx_max=max(tx_max,tmm[k]["tx1"])
+
+    # range gate dependent parts of the analysis
+    gates=[]
+    for r in range_gates:
+        # maximum number of microseconds of delay, which we analyze
+        # this is experiment specific. need to read from configuration eventually
+        n_rg=int(n.floor(maximum_range_delay/r))
+        rgs=n.arange(n_rg)*r
+        rdec=r
+        m0=int(n.round(sample0/rdec))
+        m1=int(n.round(sample1/rdec))
+        rmins=[]
+        for li in range(n_lags):
+            # determine what is the lowest range that can be estimated
+            # rg0=(gc - txstart - 0.6*pulse_length + lag)/range_decimation
+            rmin=int(n.round((sample0-111-480*min_tx_frac+lags[li])/rdec))
+            rmins.append(rmin)
+        # the ground clutter removed estimate is only needed below gc_max_delay.
+        # measurements up to one pulse length further contain echoes from these ranges. another pulse
+        # length of range gates separates them from the strong echoes above m_gc, which the filtered
+        # lagged products spread to slightly lower delays
+        r_gc=n_rg
+        m_gc=m1
+        if gc_max_delay is not None:
+            r_gc=min(n_rg,int(n.ceil(gc_max_delay/rdec)))
+            m_gc=min(m1,r_gc+2*int(n.ceil(tx_max/rdec)))
+        gates.append({"rg":r,
+                      "r_gc":r_gc,
+                      "m_gc":m_gc,
+                      "dec":int(r/rg0),
+                      "n_rg":n_rg,
+                      "rmax":n_rg,
+                      "rgs_km":rgs*rg_1us,
+                      "rdec":rdec,
+                      "m0":m0,
+                      "m1":m1,
+                      "n_meas":m1-m0,
+                      "meas_delays_us":n.arange(m0,m1)*rdec,
+                      "rmins":rmins})
+
+    # samples of the ground clutter removed echo needed for the lagged products
+    n_gc_samples=10000
+    if gc_max_delay is not None:
+        n_gc_samples=0
+        for gate in gates:
+            n_gc_samples=max(n_gc_samples,gate["m_gc"]*gate["rdec"])
+        n_gc_samples=min(10000,n_gc_samples+int(n.max(lags)))
+
+    if early_dec == "auto":
+        early_dec=early_decimation_factor(lags,rdec0,pass_band,sr=sr)
+    if (rdec0 % early_dec != 0) or (n.sum(lags % early_dec) != 0):
+        raise ValueError("early_dec=%d needs to divide the range gate and all lags"%(early_dec))
+    if sr/early_dec < 2*1.2*pass_band:
+        print("warning: early_dec=%d aliases the filter pass band"%(early_dec))
+    print("intermediate sample rate %1.0f kHz"%(sr/early_dec/1e3))
+
+    # the theory matrix plans are the same for all integration windows
+    if plan_file is not None:
+        load_convolution_plans(plan_file)
+
+    # previous solution for each channel, range gate and lag, used as a starting point by the iterative solver
+    cg_states={}
+    # the transmit pulse lagged products only change when the transmitter drifts.
+    # the transmit pulse is the leakthrough in each receiver channel, so each channel has its own
+    amb_caches={}
+    z_dcs={}
+    for channel in channels+[joint_channel]:
+        for r in range_gates:
+            cg_states[(channel,r)]={}
+    for channel in channels:
+        amb_caches[channel]=tx_cache.ambiguity_cache(lambda z_tx: lagged_products(z_tx,lags,rdec0),min_corr=tx_cache_corr)
 
         # USRP DC offset bug due to truncation instead of rounding.
         # Ryan Volz has a fix for firmware in USRPs.
         # note that this appears to change as a function of time
         # we can probably only estimate this from the estimated autocorrelation functions
-        z_dc=n.complex64(-0.212-0.221j)
+        z_dcs[channel]=n.complex64(-0.212-0.221j)
         # usrp n200 is fixed
         if channel == "zenith-l2":
-            z_dc=0.0
-        
-        bg_samples=[]
-        bg_plus_inj_samples=[]
-        z_dc_samples=[]
-
-        sidkeys=list(sid.keys())
+            z_dcs[channel]=0.0
 
-        A=[]
-        mgs=[]
-        mes=[]
-#        sigmas=[]
-        idxms=[]
-        rmins=[]
-
-        sample0=800
-        sample1=8200
-        rdec=rg
-        m0=int(n.round(sample0/rdec))
-        m1=int(n.round(sample1/rdec))
-
-        n_meas=m1-m0
-
-        # count the number of good measurements encountered as a function of delay
-        # in lagged products
-        ok_count = n.zeros(n_meas,dtype=int)
-        meas_count = n.zeros(n_meas,dtype=int)
-        meas_delays_us = n.arange(m0,m1)*rdec
-        
-        pwr_spec[:]=0.0
-        n_pwr_spec=0.0
+    if prefetch:
+        # the background thread gets its own readers
+        id_read_w = DigitalMetadataReader("%s/metadata/id_metadata"%(dirname))
+        d_il_w = DigitalRFReader("%s/rf_data/"%(dirname))
+    else:
+        id_read_w = id_read
+        d_il_w = d_il
 
+    def window_channels(i0):
+        """
+        channels that still need to be analyzed for the integration window starting at i0
+        """
+        todo_ch=[]
+        if joint:
+            # all channels are needed, until the joint analysis is done
+            n_done=0
+            for r in range_gates:
+                if os.path.exists("%s/lpi_%d%s/%s/lpi-%d.png"%(dirname,r,postfix,joint_channel,int(i0/1e6))) and reanalyze==False:
+                    n_done+=1
+            if n_done == len(range_gates):
+                print("already analyzed %s %d"%(joint_channel,i0/1e6))
+                return(todo_ch)
+        for channel in channels:
+            n_done=0
+            for r in range_gates:
+                if os.path.exists("%s/lpi_%d%s/%s/lpi-%d.png"%(dirname,r,postfix,channel,int(i0/1e6))) and reanalyze==False:
+                    n_done+=1
+            if n_done == len(range_gates) and not joint:
+                print("already analyzed %s %d"%(channel,i0/1e6))
+                continue
+            if use_products and not os.path.exists(products_fname(channel,i0)):
+                print("no lagged products stored for %s %d"%(channel,i0/1e6))
+                continue
+            todo_ch.append(channel)
+        if joint and len(todo_ch) < len(channels):
+            return([])
+        return(todo_ch)
 
-        for li in range(n_lags):
-            # determine what is the lowest range that can be estimated
-            # rg0=(gc - txstart - 0.6*pulse_length + lag)/range_decimation
-            rmin=int(n.round((sample0-111-480*min_tx_frac+lags[li])/rdec))
-            cm=convolution_matrix(n.zeros(m1),rmin=rmin,rmax=rmax)
-            rmins.append(rmin)
-            idxms.append(cm["idxm"])
-            A.append([])
-            mgs.append([])
-            mes.append([])
-        n_good_estimates=0
-
-        avg_pwr=0.0
-        avg_pwr_n=0
-        
-        # start at 3, because we may need to look back for GC
-        for keyi in range(3,n_pulses-3):
-            
-            t0=time.time()
-            key=sidkeys[keyi]
+    def load_window(ai):
+        """
+        read the pulse metadata, the transmitter state, and the dc corrected raw voltage
+        of all channels of integration window ai, or sub-window ai with overlapping windows
+        """
+        i0 = ai*int(step*idsr) + idb[0]
 
+        # get info on all the pulses transmitted during this averaging interval
+        # get some extra for gc
+        if sliding:
+            # only the pulses within the sub-window are used, but the ones around it are needed for gc
+            sid = id_read_w.read(i0-40000,i0+int(step*idsr)+40000,"sweepid")
+            analyze_channels=channels
+        else:
+            sid = id_read_w.read(i0,i0+int(avg_dur*idsr)+40000,"sweepid")
+            analyze_channels=window_channels(i0)
+
+        if use_products:
+            # the lagged products of each pulse are read when they are needed
+            products={}
+            readers={}
+            for channel in analyze_channels:
+                products[channel]=h5py.File(products_fname(channel,i0),"r")
+                readers[channel]=None
+            return({"i0":i0,"i1":i0+int(step*idsr),"sid":sid,"tx_state":{},"readers":readers,"products":products})
+
+        # transmit power and antenna pointing of each pulse. the same for all channels
+        tx_state={}
+        for key in sid.keys():
             zenith_pwr=zpm(key/1e6)
             misa_pwr=mpm(key/1e6)
-
-            if (channel == "zenith-l") or (channel=="zenith-l2"):
-                if (tx_ant(key) > -0.99) or (rx_ant(key) > -0.99) or (zenith_pwr < min_tx_pwr):
-                    print("no zenith data. P_tx %1.2f (MW) skipping"%(zenith_pwr/1e6))
-                    continue
-                else:
-                    avg_pwr+=zenith_pwr
-                    avg_pwr_n+=1            
-
-            if channel == "misa-l":
-                if (tx_ant(key) < 0.99) or (rx_ant(key) < 0.99) or (misa_pwr < min_tx_pwr):
-                    print("no misa data. skipping")
-                    continue
-                else:
-                    avg_pwr+=misa_pwr
-                    avg_pwr_n+=1
-                    
-
-            if sid[key] not in tmm.keys():
-                print("unknown pulse code %d encountered, halting."%(sid[key]))
+            tx_state[key]={"zenith_pwr":zenith_pwr,
+                           "misa_pwr":misa_pwr,
+                           "zenith":not ((tx_ant(key) > -0.99) or (rx_ant(key) > -0.99) or (zenith_pwr < min_tx_pwr)),
+                           "misa":not ((tx_ant(key) < 0.99) or (rx_ant(key) < 0.99) or (misa_pwr < min_tx_pwr))}
+
+        # one read for all the pulses in this window, including the ones used for gc removal
+        t0=time.time()
+        readers={}
+        for channel in analyze_channels:
+            readers[channel]=pulse_reader(d_il_w,channel,read_len=10000,z_dc=z_dcs[channel])
+            readers[channel].load(list(sid.keys()))
+        print("block read time %1.2f (s)"%(time.time()-t0))
+        return({"i0":i0,"i1":i0+int(step*idsr),"sid":sid,"tx_state":tx_state,"readers":readers})
+
+    todo=[]
+    if sliding:
+        # each process gets a contiguous block of integration windows, so that
+        # the sub-windows can be shared by neighbouring windows
+        n_per_rank=int(n.ceil(n_times/size))
+        todo_sub=[]
+        for ai in range(rank*n_per_rank,min((rank+1)*n_per_rank,n_times)):
+            i0 = ai*int(step*idsr) + idb[0]
+            if len(window_channels(i0)) == 0:
                 continue
-                exit(0)
-
-            z_echo=None
-            zd=None
-
-            try:
-                z_echo = d_il.read_vector_c81d(key, 10000, channel) - z_dc
-            except:
-                traceback.print_exc()
-                print("couldn't read echo")
+            for si in range(ai,ai+n_sub):
+                if si not in todo_sub:
+                    todo_sub.append(si)
+        todo=todo_sub
+    else:
+        for ai in range(rank,n_times,size):
+            i0 = ai*int(step*idsr) + idb[0]
+
+            if len(window_channels(i0)) == 0:
                 continue
+            todo.append(ai)
 
-            # no filtering of tx to get better ambiguity function
-            z_tx=n.copy(z_echo)
+    def invert_and_store(channel,i0,gate_state,stats,pwr_spec,collect_chunk=None):
+        """
+        solve the lag profile inversion of each range gate size and store the results of
+        the integration window starting at i0 into lpi_<rg><postfix>/<channel>.
 
-            if sid[key] == 300:
-                if use_long_pulse == False:
-                    # ignore long pulse
-                    continue
-                # if long pulse, then take the next long pulse
-                next_key = sidkeys[keyi+3]
-                try:
-                    z_echo1 = d_il.read_vector_c81d(next_key, 10000, channel) - z_dc
-                except:
-                    traceback.print_exc()
-                    print("couldn't read echo")
-                    continue
-                    
-                
-            elif sid[key] == sid[sidkeys[keyi+1]]:
-                # if first AC, subtract next one
-                next_key = sidkeys[keyi+1]
-                try:                
-                    z_echo1 = d_il.read_vector_c81d(next_key, 10000, channel) - z_dc
-                except:
-                    traceback.print_exc()
-                    continue
-                    
+        collect_chunk(gi,li) reads the lags starting from li of range gate gi into memory,
+        if the list based inversion doesn't have all of them
+        """
+        bg_samples=stats["bg_samples"]
+        bg_plus_inj_samples=stats["bg_plus_inj_samples"]
+        z_dc_samples=stats["z_dc_samples"]
+        avg_pwr=stats["avg_pwr"]
+        avg_pwr_n=stats["avg_pwr_n"]
+        n_pwr_spec=stats["n_pwr_spec"]
+
+        # solve and store each range gate size
+        for gi,gate in enumerate(gates):
+            gst=gate_state[gi]
+            rg=gate["rg"]
+            rdec=gate["rdec"]
+            n_rg=gate["n_rg"]
+            rmax=gate["rmax"]
+            rgs_km=gate["rgs_km"]
+            m0=gate["m0"]
+            m1=gate["m1"]
+            n_meas=gate["n_meas"]
+            meas_delays_us=gate["meas_delays_us"]
+            rmins=gate["rmins"]
+            ok_count=gst["ok_count"]
+            meas_count=gst["meas_count"]
+            if streaming:
+                ne=gst["ne"]
+                outlier_stats=gst["outlier_stats"]
+            cg_state=cg_states[(channel,rg)]
+            n_good_estimates=0
+            # one noise parameter for each channel of a joint analysis
+            n_noise=1
+            if "n_noise" in gst.keys():
+                n_noise=gst["n_noise"]
+
+            if not streaming and gst["l1"] > 0:
+                mm_ea,mm_ga,localized_sigma=ratio_test_lags(gst,ratio_threshold,sigma_threshold)
+
+            acfs_g=n.zeros([rmax,n_lags],dtype=n.complex64)
+            acfs_e=n.zeros([rmax,n_lags],dtype=n.complex64)
+
+            # store noise autocorrelation function
+            noise_e=n.zeros(n_lags,dtype=n.complex64)
+            noise_g=n.zeros(n_lags,dtype=n.complex64)
+            noise_e_rx=n.zeros([n_noise,n_lags],dtype=n.complex64)
+            noise_g_rx=n.zeros([n_noise,n_lags],dtype=n.complex64)
+
+            acfs_g[:,:]=n.nan
+            acfs_e[:,:]=n.nan
+
+            acfs_var=n.zeros([rmax,n_lags],dtype=n.float32)
+            acfs_var[:,:]=n.nan
+            # the ground clutter removed estimate has its own variance with gc_max_delay
+            acfs_g_var=n.zeros([rmax,n_lags],dtype=n.float32)
+            acfs_g_var[:,:]=n.nan
+            noise_g_var=n.zeros(n_lags,dtype=n.float32)
+            noise_g_var[:]=n.nan
+
+            noise=n.median(bg_samples)
+            alpha=(n.median(bg_plus_inj_samples)-n.median(bg_samples))/T_injection
+            T_sys=noise/alpha
+
+            for li in range(n_lags):
+                print(li)
+                if streaming:
+                    if outlier_stats[li] is None:
+                        print("not enough measurements. skipping")
+                        continue
+                    else:
+                        n_good_estimates+=1
+                    print("%d/%d measurements good"%(ne[li]["n_good"],ne[li]["n_meas"]))
+                    if ne[li]["n_good"] < n_rg:
+                        print("not enough measurements. skipping")
+                        continue
+                    ATA=ne[li]["ATA"]
+                    ATA_diag=n.diag(ATA).real
+                    ATm_e=ne[li]["ATm_e"]
+                    ATm_g=ne[li]["ATm_g"]
+                    if gc_max_delay is not None:
+                        ne_g=gst["ne_g"][li]
+                else:
+                    if li >= gst["l1"]:
+                        # the next lags that fit into memory
+                        collect_chunk(gi,li)
+                        mm_ea,mm_ga,localized_sigma=ratio_test_lags(gst,ratio_threshold,sigma_threshold)
+                    # index of this lag among the ones in memory
+                    lc=li-gst["l0"]
+                    A=gst["A"]
+                    if len(A[lc]) < 16:
+                        print("not enough measurements. skipping")
+                        continue
+                    else:
+                        n_good_estimates+=1
+
+
+                    AA=sparse.vstack(A[lc])
+                    #print(AA.shape)
+                    # the theory matrices of this lag are not needed anymore
+                    A[lc]=None
+
+                    # outliers were already removed for all lags
+                    mm_em=mm_ea[lc]
+                    mm_gm=mm_ga[lc]
+                    n_ipp=mm_em.shape[0]
+                    if gc_max_delay is None:
+                        ok_count+=n.sum((n.isnan(mm_em)!=True)*(n.isnan(mm_gm)!=True),axis=0)
+                    else:
+                        ok_count+=n.sum(n.isnan(mm_em)!=True,axis=0)
+                        # the ground clutter removed products only cover the delays below m_gc,
+                        # which are the first rows of the theory matrix of each pulse
+                        mm_gp=n.zeros(mm_em.shape,dtype=mm_gm.dtype)
+                        mm_gp[:,:]=n.nan
+                        mm_gp[:,0:mm_gm.shape[1]]=mm_gm
+                        mm_gm=mm_gp
+                    meas_count+=n_ipp
+
+                    debug_outlier_test=False
+                    if debug_outlier_test:
+                        plt.pcolormesh(mm_em.real.T)
+                        plt.colorbar()
+                        plt.show()
+
+                        plt.pcolormesh(localized_sigma[lc].T)
+                        plt.colorbar()
+                        plt.show()
+
+                    sigma_lp_est=localized_sigma[lc].flatten()
+                    mm_g=mm_gm.flatten()
+                    mm_e=mm_em.flatten()
+
+                    mm_g=mm_g/sigma_lp_est
+                    mm_e=mm_e/sigma_lp_est
+
+                    if gc_max_delay is None:
+                        gidx = n.where( (n.isnan(mm_e)==False) & (n.isnan(mm_g)==False) & (n.isnan(sigma_lp_est) == False) )[0]
+                    else:
+                        # the estimate without ground clutter removal doesn't depend on the clutter removed products
+                        good_e=(n.isnan(mm_e)==False) & (n.isnan(sigma_lp_est) == False)
+                        good_g=(n.isnan(mm_g)==False) & (n.isnan(sigma_lp_est) == False)
+                        gidx = n.where(good_e)[0]
+                        n_par=AA.shape[1]
+                        cols_g=n.concatenate([n.arange(max(min(gate["m_gc"],rmax)-rmins[li],0)),n.arange(n_par-n_noise,n_par)])
+                        # the clutter removed rows that are also good without clutter removal share
+                        # their part of A^H S^{-1} A with acfs_e. this is formed below
+                        g_rows=n.isnan(mm_g[gidx])==False
+                        mm_g_rows=mm_g[gidx][g_rows]
+                        # the few remaining ones are only good with clutter removal
+                        gidx_x=n.where(good_g & (good_e==False))[0]
+                        AW_x=sparse.diags(1/sigma_lp_est[gidx_x]).dot(AA[gidx_x,:])
+                        AT_x=n.conj(AW_x.T)
+                        ATA_x=AT_x.dot(AW_x).toarray()
+                        ATm_x=AT_x.dot(mm_g[gidx_x])
+                        # acfs_g comes from ne_g
+                        mm_g=n.zeros(len(mm_g),dtype=mm_g.dtype)
+                    print("%d/%d measurements good"%(len(gidx),len(mm_g)))
+
+                    # take outliers and bad measurements
+                    AA=AA[gidx,:]
+                    mm_g=mm_g[gidx]
+                    mm_e=mm_e[gidx]
+
+                    # at this point, we could add regularization to reduce range resolution on the top-side
+                    #
+                    # acf(rg[i])**rg[i]**2.0 = acf(rg[i+1])**rg[i+1]**2.0
+                    #
+                    # Something like this:
+                    # acf(rg[i]) - acf(rg[i+1])*(rg[i+1]**2.0/rg[i]**2.0) = 0
+                    #
+                    # n_rgs_this_lag = rmax-rmins[li]
+                    #
+
+
+                    srow=n.arange(len(gidx),dtype=int)
+                    scol=n.arange(len(gidx),dtype=int)
+                    sdata=1/sigma_lp_est[gidx]
+
+                    Sinv = sparse.csc_matrix( (sdata, (srow,scol)) ,shape=(len(gidx),len(gidx)))
+
+
+                    if len(gidx) < n_rg:
+                        print("not enough measurements. skipping")
+                        continue
+
+                    # we should probably do a
+                    # AA=n.dot(AA,Sinv)
+                    # first. this would save all the Sinv dot products. no time to test and validate this now
+                    #
+                    # A^H diag(1/sigma)
+                    AT=n.conj(AA.T).dot(Sinv)
+                    if gc_max_delay is not None:
+                        # the ground clutter removed estimate only uses the rows and range gates below m_gc.
+                        # the measurements below m_gc don't see the range gates above it
+                        # S^{-1} A in both formats, so that the products don't need conversions
+                        AW=Sinv.dot(AA)
+                        AWr=AW.tocsr()
+                        AT_g=n.conj(AW[g_rows,:].T)
+                        ATA_g=AT_g.dot(AWr[g_rows,:]).toarray()
+                        ne_g={"ATA":(ATA_g+ATA_x)[n.ix_(cols_g,cols_g)],
+                              "ATm_e":n.zeros(len(cols_g),dtype=n.complex128),
+                              "ATm_g":(AT_g.dot(mm_g_rows)+ATm_x)[cols_g],
+                              "n_good":n.sum(good_g)}
+                    if solver == "cg":
+                        # matrix-free A^H S^{-1} A, never formed explicitly
+                        AW=Sinv.dot(AA)
+                        ATA=spla.LinearOperator((AA.shape[1],AA.shape[1]),matvec=lambda x,AT=AT,AW=AW: AT.dot(AW.dot(x)),dtype=n.complex128)
+                        ATA_diag=n.array(abs(AW).power(2).sum(axis=0)).flatten()
+                    elif gc_max_delay is not None:
+                        # A^H S^{-1} A (Fisher information matrix), with the rows shared with acfs_g
+                        AT_e=n.conj(AW[g_rows==False,:].T)
+                        ATA=ATA_g+AT_e.dot(AWr[g_rows==False,:]).toarray()
+                    else:
+                        # A^H S^{-1} A (Fisher information matrix)
+                        ATA=AT.dot(n.dot(Sinv,AA)).toarray()
+
+                    # A^H \Sigma^{-1} m_g with ground clutter mitigation
+                    # note that 1/sigma is taken earlier when forming mm_g and mm_e
+                    # here we add a 1/sigma to get 1/sigma^2 on the diagonal of Sigma^{-1}
+                    ATm_g=AT.dot(mm_g)
+                    # A^H \Sigma^{-1} m_e no ground clutter mitigation
+                    # note that 1/sigma is taken earlier when forming mm_g and mm_e
+                    ATm_e=AT.dot(mm_e)
 
-            elif sid[key] == sid[sidkeys[keyi-1]]:
-                # if second AC, subtract previous one.
-                next_key = sidkeys[keyi-1]
                 try:
-                    z_echo1 = d_il.read_vector_c81d(next_key, 10000, channel) - z_dc
+                    t0=time.time()
+                    if solver == "cg":
+                        # warm start from the previous integration window of this lag
+                        x0=None
+                        var0=None
+                        if li in cg_state.keys():
+                            x0=cg_state[li]["x0"]
+                            var0=cg_state[li]["var0"]
+                        xhat_e,xhat_g,xhat_var=solve_cg_normal_equations(ATA,ATm_e,ATm_g,x0=x0,var0=var0,diag=ATA_diag,n_probe=n_probe)
+                        cg_state[li]={"x0":(xhat_e,xhat_g),"var0":xhat_var}
+                    else:
+                        xhat_e,xhat_g,xhat_var=solve_normal_equations(ATA,ATm_e,ATm_g,solver=solver,n_noise=n_noise)
+
+                    t1=time.time()
+                    t_simple=t1-t0
+                    print("simple %1.2f"%(t_simple))
+                    acfs_e[ rmins[li]:rmax, li ]=xhat_e[0:(rmax-rmins[li])]
+                    noise_e_rx[:,li]=xhat_e[(len(xhat_e)-n_noise):]
+                    noise_e[li]=noise_e_rx[0,li]
+                    if gc_max_delay is None:
+                        acfs_g[ rmins[li]:rmax, li ]=xhat_g[0:(rmax-rmins[li])]
+                        noise_g_rx[:,li]=xhat_g[(len(xhat_g)-n_noise):]
+                        noise_g[li]=noise_g_rx[0,li]
+                    elif ne_g["n_good"] >= (gate["m_gc"]-rmins[li]+1) and gate["r_gc"] > rmins[li]:
+                        # the ground clutter removed estimate, only with the delays below m_gc.
+                        # the range gates between r_gc and m_gc are only partly measured, so they are not stored
+                        # the highest range gates below m_gc are not reached by any measurement of this lag
+                        cols=n.where(n.diag(ne_g["ATA"]).real > 0)[0]
+                        t0=time.time()
+                        gc_solver=solver
+                        if gc_solver == "cg":
+                            gc_solver="inv"
+                        xg_e,xg_g,xg_var=solve_normal_equations(ne_g["ATA"][n.ix_(cols,cols)],ne_g["ATm_e"][cols],ne_g["ATm_g"][cols],solver=gc_solver,n_noise=n_noise)
+                        print("ground clutter removed %1.2f"%(time.time()-t0))
+                        xhat_gc=n.zeros(ne_g["ATA"].shape[0],dtype=xg_g.dtype)
+                        xhat_gc[:]=n.nan
+                        xhat_gc[cols]=xg_g
+                        xhat_gc_var=n.zeros(ne_g["ATA"].shape[0])
+                        xhat_gc_var[:]=n.nan
+                        xhat_gc_var[cols]=xg_var
+                        r_gc=gate["r_gc"]
+                        acfs_g[ rmins[li]:r_gc, li ]=xhat_gc[0:(r_gc-rmins[li])]
+                        acfs_g_var[ rmins[li]:r_gc, li ]=xhat_gc_var[0:(r_gc-rmins[li])]
+                        noise_g_rx[:,li]=xhat_gc[(len(xhat_gc)-n_noise):]
+                        noise_g[li]=noise_g_rx[0,li]
+                        noise_g_var[li]=xhat_gc_var[len(xhat_gc_var)-n_noise]
+
+                    acfs_var[ rmins[li]:rmax, li ] = xhat_var[0:(rmax-rmins[li])]
                 except:
                     traceback.print_exc()
-                    continue
-
-                if debug_gc_rem:
-                    plt.plot(zd.real+2000)
-                    plt.plot(zd.imag+2000)
-                    plt.plot(z_echo.real)
-                    plt.plot(z_echo.imag)            
-                    plt.title(sid[key])            
-                    plt.show()
-
-
-            noise0=tmm[sid[key]]["noise0"]
-            noise1=tmm[sid[key]]["noise1"]
-            last_echo=tmm[sid[key]]["last_echo"]
-            tx0=tmm[sid[key]]["tx0"]
-            tx1=tmm[sid[key]]["tx1"]
-            gc=tmm[sid[key]]["gc"]
-            e_gc=tmm[sid[key]]["e_gc"]
-
-
-
-            # filter noise injection.
-            z_noise=n.copy(z_echo)
-            z_noise=lpf.lpf(z_noise)
-
-            # the dc offset changes
-            z_dc_noise=n.mean(z_noise[(last_echo-500):last_echo])
-            z_dc_samples.append(z_dc_noise)
-            bg_samples.append( n.mean(n.abs(z_noise[(last_echo-500):last_echo]-z_dc_noise)**2.0) )
-            bg_plus_inj_samples.append( n.mean(n.abs(z_noise[(noise0):noise1]-z_dc_noise)**2.0) )
-
-            z_tx[0:tx0]=0.0
-            z_tx[tx1:10000]=0.0
-
-            # normalize tx pwr
-            z_tx=z_tx/n.sqrt(n.sum(n.real(z_tx*n.conj(z_tx))))
-            z_echo[last_echo:10000]=0.0
-            z_echo1[last_echo:10000]=0.0
-
-            z_echo[0:gc]=0.0
-            z_echo1[0:gc]=0.0
-
-
-            if False:
-                plt.subplot(121)
-                plt.plot(z_tx.real)
-                plt.plot(z_tx.imag)
-                plt.subplot(122)
-                plt.plot(z_echo.real)
-                plt.plot(z_echo.imag)
-                plt.show()
-
-            if False:
-                # testing notching of frequencies.
-                ZE=fft(z_echo)
-                ZE1=fft(z_echo1)
-                z_fftfreq=n.fft.fftfreq(len(z_echo),d=1/sr)
-
-                if False:
-                    plt.plot(n.fft.fftshift(z_fftfreq),n.fft.fftshift(10.0*n.log10(n.abs(ZE))**2.0))
-                    plt.show()
-
-                for freq_range in notch_freq_range:
-                    fridx0=n.argmin(n.abs(z_fftfreq-freq_range[0]))
-                    fridx1=n.argmin(n.abs(z_fftfreq-freq_range[1]))
-                    noise_std=n.sqrt(0.25*(n.mean(n.abs(ZE[(fridx0-200):(fridx0-100)])**2.0)+n.mean(n.abs(ZE[(fridx1+100):(fridx1+200)])**2.0)+n.mean(n.abs(ZE1[(fridx0-200):(fridx0-100)])**2.0)+n.mean(n.abs(ZE1[(fridx1+100):(fridx1+200)])**2.0)))
-                    nrand=fridx1-fridx0
-
-                    ZE[fridx0:fridx1]=noise_std*(n.random.randn(nrand)+n.random.randn(nrand)*1j)/n.sqrt(2.0)
-                    ZE1[fridx0:fridx1]=noise_std*(n.random.randn(nrand)+n.random.randn(nrand)*1j)/n.sqrt(2.0)
-
-                if False:
-                    plt.plot(n.fft.fftshift(z_fftfreq),n.fft.fftshift(10.0*n.log10(n.abs(ZE))**2.0))                
-                    plt.show()
-
-                z_echo=ifft(ZE)
-                z_echo1=ifft(ZE1)
-
-                
-
-            # calculate power spectrum after notch
-            Z=n.fft.fftshift(fft(spec_window*z_echo[(last_echo-fft_len):(last_echo)]))
-            pwr_spec+=n.real(Z*n.conj(Z))
-            n_pwr_spec+=1.0
-
-            z_echo=lpf.lpf(z_echo)
-            z_echo1=lpf.lpf(z_echo1)
-
-            zd=z_echo-z_echo1
-
-            zd[0:gc]=n.nan
-            z_echo[0:gc]=n.nan
-            z_echo[last_echo:10000]=n.nan
-            zd[last_echo:10000]=n.nan        
-            t1=time.time()
-            read_time=t1-t0
-            t0=time.time()
-            for li in range(n_lags):
-                for ai in range(lag_avg):
-                    amb=decim.decimate(z_tx[0:(len(z_tx)-lags[li+ai])]*n.conj(z_tx[lags[li+ai]:len(z_tx)]))
-
-                    # gc removal by the T. Turunen subtraction of two pulses with the same code, transmitted in
-                    # close proximity to one another.
-                    measg=decim.decimate(zd[0:(len(z_echo)-lags[li+ai])]*n.conj(zd[lags[li+ai]:len(z_echo)]))
-
-                    # no gc removal
-                    mease=decim.decimate(z_echo[0:(len(z_echo)-lags[li+ai])]*n.conj(z_echo[lags[li+ai]:len(z_echo)]))
-
-                    #TM=amb[idxms[li]]
-                    # add a column of ones to allow an additional noise process that is independent of range
-                    O=n.ones(m1,dtype=n.complex64)
-                    O.shape=(m1,1)
-                    TM=n.hstack([amb[idxms[li]],O])
-                    TM=sparse.csc_matrix(TM[m0:m1,:])
-
-                    mgs[li].append(measg[m0:m1])
-                    mes[li].append(mease[m0:m1])
-                    A[li].append(TM)
-            t1=time.time()
-            ambiguity_time=t1-t0
-            print("prep %d/%d ambiguity time %1.2f read time %1.2f (s)"%(keyi,n_pulses,ambiguity_time,read_time))            
-
-        acfs_g=n.zeros([rmax,n_lags],dtype=n.complex64)
-        acfs_e=n.zeros([rmax,n_lags],dtype=n.complex64)
-        
-        # store noise autocorrelation function
-        noise_e=n.zeros(n_lags,dtype=n.complex64)
-        noise_g=n.zeros(n_lags,dtype=n.complex64)
-        
-        acfs_g[:,:]=n.nan
-        acfs_e[:,:]=n.nan    
-
-        acfs_var=n.zeros([rmax,n_lags],dtype=n.float32)
-        acfs_var[:,:]=n.nan
-
-        noise=n.median(bg_samples)    
-        alpha=(n.median(bg_plus_inj_samples)-n.median(bg_samples))/T_injection 
-        T_sys=noise/alpha
-
-        for li in range(n_lags):
-            print(li)
-            if len(A[li]) < 16:
-                print("not enough measurements. skipping")
-                continue
-            else:
-                n_good_estimates+=1
-            
-            
-            AA=sparse.vstack(A[li])
-            #print(AA.shape)
-            mm_g=n.concatenate(mgs[li])
-            mm_e=n.concatenate(mes[li])
-            sigma_lp_est=n.zeros(len(mm_g))
-            sigma_lp_est[:]=1.0
-            
-            n_ipp=0
-            # remove outliers and estimate standard deviation 
-            if True:
-                print("ratio test")
-                # tbd: estimate the fourth moments for lagged products
-                # 
-                # <(m_t m_{t+\tau}^*) (m_t^* m_{t+\tau})>
-                # but also for this one:
-                # <(m_t m_{t+\tau}^*) (m_t m_{t+\tau}^*)>
-                # as it might not be zero when snr is high!!!
-                # this would require doing the least-squares with
-                # a slightly different method
-                # 
-                mm_gm=n.copy(mm_g)
-                mm_em=n.copy(mm_e)
-                n_ipp=int(len(mm_gm)/n_meas)
-                mm_gm.shape=(n_ipp,n_meas)
-                mm_em.shape=(n_ipp,n_meas)
-
-                
-                sigma_lp_est=n.sqrt(n.percentile(n.abs(mm_em[:,:])**2.0,34,axis=0)*2.0)
-                sigma_lp_est_g=n.sqrt(n.percentile(n.abs(mm_gm[:,:])**2.0,34,axis=0)*2.0)            
-
-                ratio_test=n.abs(mm_em)/sigma_lp_est
-                ratio_test_g=n.abs(mm_gm)/sigma_lp_est_g
-
-                localized_sigma=n.abs(n.copy(mm_em))**2.0
-                wf=n.repeat(1/10,10)
-                WF=fft(wf,localized_sigma.shape[0])
-                for ri in range(mm_em.shape[1]):
-                    # we need to wrap around, to avoid too low values.
-                    localized_sigma[:,ri]=n.roll(n.sqrt(ifft(WF*fft(localized_sigma[:,ri])).real),-5)
-
-                # make sure we don't have a division by zero
-                msig=n.nanmedian(localized_sigma)
-                if msig<0:
-                    msig=1.0
-                localized_sigma[localized_sigma<msig]=msig
-
-
-                if False:
-                    plt.pcolormesh(localized_sigma.T)
-                    plt.colorbar()
-                    plt.show()
-
-                    plt.pcolormesh(ratio_test.T)
-                    plt.colorbar()
-                    plt.show()
-                    plt.pcolormesh(ratio_test_g.T)
-                    plt.colorbar()
-                    plt.show()
-
-                debug_outlier_test=False
-                if debug_outlier_test:
-                    plt.pcolormesh(mm_em.real.T)
-                    plt.colorbar()
-                    plt.show()
-
-
-                # is this threshold too high?
-                # maybe 6-7 might still be possible.
-                mm_em[ratio_test > 10]=n.nan
-                mm_gm[ratio_test_g > 10]=n.nan
-
-                # these will be shit no matter what
-                mm_em[localized_sigma > 100*msig]=n.nan
-                mm_gm[localized_sigma > 100*msig]=n.nan
-
-                ok_count+=n.sum((n.isnan(mm_em)!=True)*(n.isnan(mm_gm)!=True),axis=0)
-                meas_count+=n_ipp
-                
-                if debug_outlier_test:            
-                    plt.pcolormesh(mm_em.real.T)
-                    plt.colorbar()
-                    plt.show()
-
-                    plt.pcolormesh(localized_sigma.T)
+                    print("something went wrong.")
+
+            if n_good_estimates > 0:
+                print("saving")
+                if save_acf_images:
+                    # plot real part of acf
+                    acf_std=1.77*n.nanmedian(n.abs(acfs_e.real))
+                    plt.pcolormesh(mean_lags,rgs_km[0:rmax],acfs_e.real,vmin=-acf_std,vmax=2*acf_std)
+                    plt.xlabel("Lag ($\mu$s)")
+                    plt.ylabel("Range (km)")
                     plt.colorbar()
-                    plt.show()
-
-                sigma_lp_est=localized_sigma
-                sigma_lp_est.shape=(len(mm_g),)
-
-                mm_gm.shape=(len(mm_g),)
-                mm_em.shape=(len(mm_e),)
-                mm_g=mm_gm
-                mm_e=mm_em
-
-            mm_g=mm_g/sigma_lp_est
-            mm_e=mm_e/sigma_lp_est
-
-            gidx = n.where( (n.isnan(mm_e)==False) & (n.isnan(mm_g)==False) & (n.isnan(sigma_lp_est) == False) )[0]
-            print("%d/%d measurements good"%(len(gidx),len(mm_g)))
-
-            # take outliers and bad measurements
-            AA=AA[gidx,:]
-            mm_g=mm_g[gidx]
-            mm_e=mm_e[gidx]
-            
-            # at this point, we could add regularization to reduce range resolution on the top-side
-            #
-            # acf(rg[i])**rg[i]**2.0 = acf(rg[i+1])**rg[i+1]**2.0
-            #
-            # Something like this:
-            # acf(rg[i]) - acf(rg[i+1])*(rg[i+1]**2.0/rg[i]**2.0) = 0
-            #
-            # n_rgs_this_lag = rmax-rmins[li]
-            #
-
-            
-            srow=n.arange(len(gidx),dtype=int)
-            scol=n.arange(len(gidx),dtype=int)
-            sdata=1/sigma_lp_est[gidx]
-
-            Sinv = sparse.csc_matrix( (sdata, (srow,scol)) ,shape=(len(gidx),len(gidx)))
-
-
-            if len(gidx) < n_rg:
-                print("not enough measurements. skipping")
-                continue
-                
-            
+                    plt.title("%s T_sys=%1.0f K"%(stuffr.unix2datestr(i0/sr),T_sys))
+                    plt.tight_layout()
+                    plt.savefig("%s/lpi_%d%s/%s/lpi-%d.png"%(dirname,rg,postfix,channel,i0/sr))
+                    plt.close()
+                    plt.clf()
+
+                #
+                # tbd: determine if this could be done better with digital_metadata
+                #
+                ho=h5py.File("%s/lpi_%d%s/%s/lpi-%d.h5"%(dirname,rg,postfix,channel,i0/sr),"w")
+                ho["acfs_g"]=acfs_g       # pulse to pulse ground clutter removal
+                ho["acfs_e"]=acfs_e       # no ground clutter removal
+                ho["noise_e"]=noise_e     # store estimated noise ACF
+                ho["noise_g"]=noise_g     # store estimated noise ACF   
+                if n_noise > 1:
+                    # joint analysis. the noise of each channel, and the noise_e and noise_g of the first one.
+                    # the lagged products of all channels are scaled to the units of the first channel
+                    ho["noise_e_rx"]=noise_e_rx
+                    ho["noise_g_rx"]=noise_g_rx
+                    ho["channels"]=channel.split("+")
+                ho["acfs_var"]=acfs_var   # variance of the acf estimate
+                ho["rgs_km"]=rgs_km[0:rmax]
+                ho["channel"]=channel
+                ho["P_tx"]=avg_pwr/avg_pwr_n
+                ho["lags"]=mean_lags/sr
+                # tbd: save t0 and t1 to indicate time span in this output
+                ho["i0"]=i0/sr
+                ho["T_sys"]=T_sys     # T_sys = alpha*noise_power
+                ho["alpha"]=alpha     # This can scale power to T_sys (e.g., noise_power = T_sys/alpha)   T_sys * power/noise_pwr = T_pwr
+                #
+                ho["z_dc"]=n.median(z_dc_samples)
+                ho["pass_band"]=pass_band        # sort of important to store this, as this defines the low pass filter  
+                ho["filter_len"]=filter_len      #
+                ho["n_prescreen"]=stats["n_prescreen"]                  # pulses checked by the pre-screen
+                ho["n_prescreen_clipped"]=stats["n_prescreen_clipped"]  # and rejected because of clipping,
+                ho["n_prescreen_peak"]=stats["n_prescreen_peak"]        # a bright peak,
+                ho["n_prescreen_noise"]=stats["n_prescreen_noise"]      # or high background noise
+                if gc_max_delay is not None:
+                    ho["gc_max_delay"]=gc_max_delay  # acfs_g is only estimated below this delay (us)
+                    ho["acfs_g_var"]=acfs_g_var      # variance of acfs_g, which has its own inversion. acfs_var is the variance of acfs_e
+                    ho["noise_g_var"]=noise_g_var    # variance of noise_g
+                # keep track of how many lagged products are rejected as bad as a function of time delay
+                ho["retained_measurement_fraction"]=n.array(ok_count/meas_count,dtype=n.float32)
+                ho["meas_delays_us"]=meas_delays_us
+                ho["diagnostic_pwr_spec"]=pwr_spec/n_pwr_spec
+                ho.close()
+            else:
+                print("no estimates in this integration period")
+
+    # running sums of the sub-windows of each channel
+    sliding_sums={}
+    for channel in channels:
+        sliding_sums[channel]=sliding_normal_equations(n_sub)
+
+    # go through one integration window at a time,
+    # while the next one is read in the background
+    for ai,window in prefetch_mod.iterate_windows(load_window,todo,prefetch=prefetch):
+        if window is None:
+            print("couldn't read integration window %d"%(ai))
+            continue
 
+        i0=window["i0"]
+        sid=window["sid"]
+        tx_state=window["tx_state"]
+
+        # with the joint analysis, the transmit pulse products of the first channel are used for
+        # all channels, and the normal equations of each channel are combined at the end
+        shared_ambs={}
+        joint_parts=[]
+
+        # all channels use the same pulses of this window
+        for channel in window["readers"].keys():
+            reader=window["readers"][channel]
+            if reader is not None:
+                # single pulse reads after the block read are done in this thread
+                reader.d_il=d_il
+            amb_cache=amb_caches[channel]
+
+            n_pulses=len(sid.keys())
+
+            sidkeys=list(sid.keys())
+
+            # how many lags fit into memory at once
+            mem_per_lag,mem_fixed=estimate_lpi_memory(n_pulses,n_lags,lag_avg,gates,tx_max,streaming=streaming)
+            chunk_lags=n_lags
+            if memory_budget is not None and not streaming and (mem_per_lag*n_lags+mem_fixed) > memory_budget:
+                chunk_lags=int(max(1,min(n_lags,n.floor((memory_budget-mem_fixed)/mem_per_lag))))
+            n_passes=1
+            if streaming:
+                n_passes=2
+            elif chunk_lags < n_lags:
+                n_passes=len(gates)*int(n.ceil(n_lags/chunk_lags))
+            print("memory estimate %1.2f GB. %d lags at a time, %d passes over the pulses"%((mem_per_lag*chunk_lags+mem_fixed)/1e9,chunk_lags,n_passes))
+            if memory_budget is not None and (mem_per_lag*chunk_lags+mem_fixed) > memory_budget:
+                print("warning: memory estimate exceeds the budget of %1.2f GB"%(memory_budget/1e9))
+
+            # theory matrices and measurements of each range gate size. lags l0..l1-1 are in memory
+            gate_state=[]
+            for gate in gates:
+                gst={"A":[],"mgs":[],"mes":[],"l0":0,"l1":0}
+                # count the number of good measurements encountered as a function of delay
+                # in lagged products
+                gst["ok_count"]=n.zeros(gate["n_meas"],dtype=int)
+                gst["meas_count"]=n.zeros(gate["n_meas"],dtype=int)
+                gate_state.append(gst)
+
+            pwr_spec[:]=0.0
+
+            pwriter=None
+            if save_products and not use_products:
+                pwriter=product_writer(products_fname(channel,window["i0"]))
+
+            # noise, dc and tx power statistics, collected only on the first pass over the pulses
+            stats={"bg_samples":[],
+                   "bg_plus_inj_samples":[],
+                   "z_dc_samples":[],
+                   "avg_pwr":0.0,
+                   "avg_pwr_n":0,
+                   "n_pwr_spec":0.0,
+                   "n_prescreen":0,
+                   "n_prescreen_clipped":0,
+                   "n_prescreen_peak":0,
+                   "n_prescreen_noise":0}
+
+            def pulse_products(stats=None):
+                """
+                read, filter and calculate the lagged products of all good pulses in this
+                integration window. this can be iterated over more than once.
+                the noise statistics are only collected into stats if it is given.
+                """
+                if use_products:
+                    # lagged products stored by an earlier run. these are with the range decimation
+                    # of that run, which may be finer than what is needed now
+                    prod=window["products"][channel]
+                    if rdec0 % int(prod["rdec"][()]) != 0 or len(prod["lags"][()]) != len(lags) or n.sum(prod["lags"][()] != lags) != 0:
+                        print("stored lagged products are not compatible with rg=%d and lags. skipping"%(rdec0))
+                        return
+                    fdec=int(rdec0/int(prod["rdec"][()]))
+                    if len(prod["keys"][()]) > 0 and prod["measgs"].shape[2]*int(prod["rdec"][()]) < int(n_gc_samples/rdec0)*rdec0:
+                        print("stored ground clutter removed lagged products cover too few delays. skipping")
+                        return
+                    if stats is not None:
+                        for k in ["bg_samples","bg_plus_inj_samples","z_dc_samples"]:
+                            stats[k]+=list(prod[k][()])
+                        for k in ["avg_pwr","avg_pwr_n","n_pwr_spec","n_prescreen","n_prescreen_clipped","n_prescreen_peak","n_prescreen_noise"]:
+                            if k in prod.keys():
+                                stats[k]+=prod[k][()]
+                        pwr_spec[:]+=prod["pwr_spec"][()]
+                    for pi,key in enumerate(prod["keys"][()]):
+                        yield({"key":key,
+                               "ambs":coarsen_products(prod["ambs"][pi],fdec),
+                               "measgs":coarsen_products(prod["measgs"][pi],fdec),
+                               "meases":coarsen_products(prod["meases"][pi],fdec)})
+                    return
+
+                screen=None
+                if prescreen:
+                    screen=prescreen_mod.pulse_prescreen(max_noise_ratio=max_noise_ratio,
+                                                         max_peak_ratio=max_peak_ratio,
+                                                         clip_level=clip_level,
+                                                         max_clipped=max_clipped)
+
+                # start at 3, because we may need to look back for GC
+                for keyi in range(3,n_pulses-3):
+
+                    t0=time.time()
+                    key=sidkeys[keyi]
+
+                    if sliding and ((key < window["i0"]) or (key >= window["i1"])):
+                        # belongs to another sub-window
+                        continue
+
+                    zenith_pwr=tx_state[key]["zenith_pwr"]
+                    misa_pwr=tx_state[key]["misa_pwr"]
+
+                    if (channel == "zenith-l") or (channel=="zenith-l2"):
+                        if not tx_state[key]["zenith"]:
+                            print("no zenith data. P_tx %1.2f (MW) skipping"%(zenith_pwr/1e6))
+                            continue
+                        elif stats is not None:
+                            stats["avg_pwr"]+=zenith_pwr
+                            stats["avg_pwr_n"]+=1
+
+                    if channel == "misa-l":
+                        if not tx_state[key]["misa"]:
+                            print("no misa data. skipping")
+                            continue
+                        elif stats is not None:
+                            stats["avg_pwr"]+=misa_pwr
+                            stats["avg_pwr_n"]+=1
+
+
+                    if sid[key] not in tmm.keys():
+                        print("unknown pulse code %d encountered, halting."%(sid[key]))
+                        continue
+                        exit(0)
+
+                    z_echo=None
+                    zd=None
+
+                    try:
+                        z_echo = n.copy(reader.read(key))
+                    except:
+                        traceback.print_exc()
+                        print("couldn't read echo")
+                        continue
+
+                    # no filtering of tx to get better ambiguity function
+                    z_tx=n.copy(z_echo)
+
+                    if sid[key] == 300:
+                        if use_long_pulse == False:
+                            # ignore long pulse
+                            continue
+                        # if long pulse, then take the next long pulse
+                        next_key = sidkeys[keyi+3]
+                        try:
+                            z_echo1 = n.copy(reader.read(next_key))
+                        except:
+                            traceback.print_exc()
+                            print("couldn't read echo")
+                            continue
+
+
+                    elif sid[key] == sid[sidkeys[keyi+1]]:
+                        # if first AC, subtract next one
+                        next_key = sidkeys[keyi+1]
+                        try:
+                            z_echo1 = n.copy(reader.read(next_key))
+                        except:
+                            traceback.print_exc()
+                            continue
+
+
+                    elif sid[key] == sid[sidkeys[keyi-1]]:
+                        # if second AC, subtract previous one.
+                        next_key = sidkeys[keyi-1]
+                        try:
+                            z_echo1 = n.copy(reader.read(next_key))
+                        except:
+                            traceback.print_exc()
+                            continue
+
+                        if debug_gc_rem:
+                            plt.plot(zd.real+2000)
+                            plt.plot(zd.imag+2000)
+                            plt.plot(z_echo.real)
+                            plt.plot(z_echo.imag)
+                            plt.title(sid[key])
+                            plt.show()
+
+
+                    if screen is not None:
+                        # cheap check of the raw echoes, before the filtering and lagged products
+                        reason=screen.check(n.array([z_echo,z_echo1]),tmm[sid[key]]["gc"],tmm[sid[key]]["last_echo"])
+                        if reason is not None:
+                            print("pre-screen rejected pulse %d/%d (%s)"%(keyi,n_pulses,reason))
+                            continue
+
+                    noise0=tmm[sid[key]]["noise0"]
+                    noise1=tmm[sid[key]]["noise1"]
+                    last_echo=tmm[sid[key]]["last_echo"]
+                    tx0=tmm[sid[key]]["tx0"]
+                    tx1=tmm[sid[key]]["tx1"]
+                    gc=tmm[sid[key]]["gc"]
+                    e_gc=tmm[sid[key]]["e_gc"]
+
+                    # unfiltered and ungated copy for the noise injection
+                    z_noise=n.copy(z_echo)
+
+                    z_tx[0:tx0]=0.0
+                    z_tx[tx1:10000]=0.0
+
+                    # normalize tx pwr
+                    z_tx=z_tx/n.sqrt(n.sum(n.real(z_tx*n.conj(z_tx))))
+                    z_echo[last_echo:10000]=0.0
+                    z_echo1[last_echo:10000]=0.0
+
+                    z_echo[0:gc]=0.0
+                    z_echo1[0:gc]=0.0
+
+
+                    if False:
+                        plt.subplot(121)
+                        plt.plot(z_tx.real)
+                        plt.plot(z_tx.imag)
+                        plt.subplot(122)
+                        plt.plot(z_echo.real)
+                        plt.plot(z_echo.imag)
+                        plt.show()
+
+                    if stats is not None:
+                        # calculate power spectrum before the notch, to identify RFI
+                        Z=n.fft.fftshift(fft(spec_window*z_echo[(last_echo-fft_len):(last_echo)]))
+                        pwr_spec[:]+=n.real(Z*n.conj(Z))
+                        stats["n_pwr_spec"]+=1.0
+
+                        # low pass filter and notch the noise injection and both echoes in one batch
+                        z_noise,z_echo,z_echo1=lpf.filter(n.array([z_noise,z_echo,z_echo1]))
+
+                        # the dc offset changes
+                        z_dc_noise=n.mean(z_noise[(last_echo-500):last_echo])
+                        stats["z_dc_samples"].append(z_dc_noise)
+                        stats["bg_samples"].append( n.mean(n.abs(z_noise[(last_echo-500):last_echo]-z_dc_noise)**2.0) )
+                        stats["bg_plus_inj_samples"].append( n.mean(n.abs(z_noise[(noise0):noise1]-z_dc_noise)**2.0) )
+                    else:
+                        z_echo,z_echo1=lpf.filter(n.array([z_echo,z_echo1]))
+
+                    zd=z_echo-z_echo1
+
+                    zd[0:gc]=n.nan
+                    z_echo[0:gc]=n.nan
+                    z_echo[last_echo:10000]=n.nan
+                    zd[last_echo:10000]=n.nan
+                    t1=time.time()
+                    read_time=t1-t0
+                    t0=time.time()
+                    # lagged products for all distinct lags, each computed once. with lag_avg > 1
+                    # neighbouring li reuse the same rows.
+                    # the transmit pulse is not filtered, so its ambiguity is always at the full rate
+                    if joint and channel != channels[0] and key in shared_ambs:
+                        ambs=shared_ambs[key]
+                    else:
+                        ambs=amb_cache.get(sid[key],z_tx)
+                        if joint:
+                            shared_ambs[key]=ambs
+                    if early_dec > 1:
+                        # the filtered echoes are band limited. keep every early_dec'th sample, and
+                        # multiply the block sums by early_dec to keep the same magic constant.
+                        measgs=early_dec*lagged_products(zd[0:n_gc_samples:early_dec],lags//early_dec,rdec0//early_dec)
+                        meases=early_dec*lagged_products(z_echo[::early_dec],lags//early_dec,rdec0//early_dec)
+                    else:
+                        # gc removal by the T. Turunen subtraction of two pulses with the same code, transmitted in
+                        # close proximity to one another.
+                        measgs=lagged_products(zd[0:n_gc_samples],lags,rdec0)
+                        # no gc removal
+                        meases=lagged_products(z_echo,lags,rdec0)
+                    t1=time.time()
+                    ambiguity_time=t1-t0
+                    print("prep %d/%d ambiguity time %1.2f read time %1.2f (s)"%(keyi,n_pulses,ambiguity_time,read_time))
+                    if stats is not None and pwriter is not None:
+                        pwriter.add(key,ambs,measgs,meases)
+                    yield({"key":key,"ambs":ambs,"measgs":measgs,"meases":meases})
+
+                if stats is not None and screen is not None:
+                    stats["n_prescreen"]+=screen.counts["checked"]
+                    for k in ["clipped","peak","noise"]:
+                        stats["n_prescreen_%s"%(k)]+=screen.counts[k]
+                    print("pre-screen rejected %d/%d pulses (clipped %d peak %d noise %d)"%(screen.counts["clipped"]+screen.counts["peak"]+screen.counts["noise"],
+                                                                                            screen.counts["checked"],
+                                                                                            screen.counts["clipped"],
+                                                                                            screen.counts["peak"],
+                                                                                            screen.counts["noise"]))
+
+            def gate_products(p,gate):
+                """
+                ambiguity functions and measurements of one pulse, decimated to the range gate of gate
+                """
+                f=gate["dec"]
+                return(coarsen_products(p["ambs"],f),
+                       coarsen_products(p["measgs"],f)[:,gate["m0"]:gate["m_gc"]],
+                       coarsen_products(p["meases"],f)[:,gate["m0"]:gate["m1"]])
+
+            def collect_lags(gis,l0,l1,stats=None):
+                """
+                theory matrices and lagged products of lags l0..l1-1 of range gates gis,
+                with one pass over the pulses. replaces the lags that were in memory before
+                """
+                for gi in gis:
+                    gst=gate_state[gi]
+                    gst["l0"]=l0
+                    gst["l1"]=l1
+                    gst["A"]=[]
+                    gst["mgs"]=[]
+                    gst["mes"]=[]
+                    for li in range(l0,l1):
+                        gst["A"].append([])
+                        gst["mgs"].append([])
+                        gst["mes"].append([])
+                for p in pulse_products(stats):
+                    for gi in gis:
+                        gate=gates[gi]
+                        gst=gate_state[gi]
+                        ambs,measgs,meases=gate_products(p,gate)
+                        for li in range(l0,l1):
+                            for lai in range(lag_avg):
+                                TM=theory_matrix(ambs[li+lai,:],gate["rmins"][li],gate["rmax"],gate["m0"],gate["m1"])
+
+                                gst["mgs"][li-l0].append(measgs[li+lai,:])
+                                gst["mes"][li-l0].append(meases[li+lai,:])
+                                gst["A"][li-l0].append(TM)
+
+            def collect_chunk(gi,l0):
+                """
+                the next lags of range gate gi, that fit into memory
+                """
+                collect_lags([gi],l0,min(n_lags,l0+chunk_lags))
+
+            if streaming:
+                # pass one. only keep the power of the lagged products, which is what
+                # the ratio test needs. rows are in the same order as in the stacked theory matrix.
+                for gst in gate_state:
+                    gst["pwr_e"]=[]
+                    gst["pwr_g"]=[]
+                    for li in range(n_lags):
+                        gst["pwr_e"].append([])
+                        gst["pwr_g"].append([])
+                pulse_keys=[]
+                for p in pulse_products(stats):
+                    pulse_keys.append(p["key"])
+                    for gi,gate in enumerate(gates):
+                        gst=gate_state[gi]
+                        ambs,measgs,meases=gate_products(p,gate)
+                        for li in range(n_lags):
+                            for lai in range(lag_avg):
+                                gst["pwr_e"][li].append(n.array(n.abs(meases[li+lai,:])**2.0,dtype=n.float32))
+                                gst["pwr_g"][li].append(n.array(n.abs(measgs[li+lai,:])**2.0,dtype=n.float32))
+                row_idx={}
+                for pi,key in enumerate(pulse_keys):
+                    row_idx[key]=pi*lag_avg
+
+                for gi,gate in enumerate(gates):
+                    gst=gate_state[gi]
+                    # the ratio test statistics, for all lags at once
+                    gst["outlier_stats"]=[None]*n_lags
+                    if len(pulse_keys)*lag_avg >= 16:
+                        sigma_lp_est,sigma_lp_est_g,localized_sigma,msig=batched_outlier_statistics(n.array(gst["pwr_e"]),n.array(gst["pwr_g"]))
+                        for li in range(n_lags):
+                            gst["outlier_stats"][li]=(sigma_lp_est[li],sigma_lp_est_g[li],localized_sigma[li],msig[li])
+                            gst["meas_count"]+=len(gst["pwr_e"][li])
+                    del gst["pwr_e"]
+                    del gst["pwr_g"]
+                    gst["ne"]=[]
+                    for li in range(n_lags):
+                        gst["ne"].append(normal_equations(gate["rmax"]-gate["rmins"][li]+1))
+                    if gc_max_delay is not None:
+                        # smaller normal equations for the ground clutter removed estimate
+                        gst["ne_g"]=[]
+                        for li in range(n_lags):
+                            gst["ne_g"].append(normal_equations(max(gate["m_gc"]-gate["rmins"][li],0)+1))
+
+                # pass two. accumulate the normal equations one pulse at a time.
+                for p in pulse_products():
+                    if p["key"] not in row_idx:
+                        continue
+                    ri=row_idx[p["key"]]
+                    for gi,gate in enumerate(gates):
+                        gst=gate_state[gi]
+                        ambs,measgs,meases=gate_products(p,gate)
+                        for li in range(n_lags):
+                            if gst["outlier_stats"][li] is None:
+                                continue
+                            sigma_lp_est,sigma_lp_est_g,localized_sigma,msig=gst["outlier_stats"][li]
+                            for lai in range(lag_avg):
+                                TM=theory_matrix(ambs[li+lai,:],gate["rmins"][li],gate["rmax"],gate["m0"],gate["m1"])
+                                mm_e=n.copy(meases[li+lai,:])
+                                mm_g=n.copy(measgs[li+lai,:])
+                                reject_outliers(mm_e,mm_g,sigma_lp_est,sigma_lp_est_g,localized_sigma[ri+lai,:],msig,ratio_threshold,sigma_threshold)
+                                if gc_max_delay is None:
+                                    gst["ok_count"]+=(n.isnan(mm_e)!=True)*(n.isnan(mm_g)!=True)
+                                    accumulate_normal_equations(gst["ne"][li],TM,mm_e,mm_g,localized_sigma[ri+lai,:])
+                                else:
+                                    gst["ok_count"]+=(n.isnan(mm_e)!=True)
+                                    accumulate_normal_equations(gst["ne"][li],TM,mm_e,None,localized_sigma[ri+lai,:])
+                                    if gate["m_gc"] > gate["rmins"][li]:
+                                        # rows and range gates up to m_gc
+                                        TM_g=theory_matrix(ambs[li+lai,:],gate["rmins"][li],gate["m_gc"],gate["m0"],gate["m_gc"])
+                                        accumulate_normal_equations(gst["ne_g"][li],TM_g,None,mm_g,localized_sigma[ri+lai,0:(gate["m_gc"]-gate["m0"])])
+            else:
+                # the first pass also collects the noise statistics. if all lags don't fit into memory,
+                # the rest of the lags and range gates are read with more passes when they are solved
+                if chunk_lags < n_lags:
+                    collect_lags([0],0,chunk_lags,stats)
+                else:
+                    collect_lags(range(len(gates)),0,n_lags,stats)
+
+            print("transmit pulse products cached %d recalculated %d"%(amb_cache.n_hit,amb_cache.n_miss))
+            if pwriter is not None:
+                pwriter.close({"i0":window["i0"]/sr,
+                               "avg_dur":step,
+                               "channel":channel,
+                               "lags":lags,
+                               "rdec":rdec0,
+                               "pass_band":pass_band,
+                               "filter_len":filter_len,
+                               "bg_samples":stats["bg_samples"],
+                               "bg_plus_inj_samples":stats["bg_plus_inj_samples"],
+                               "z_dc_samples":stats["z_dc_samples"],
+                               "avg_pwr":stats["avg_pwr"],
+                               "avg_pwr_n":stats["avg_pwr_n"],
+                               "n_pwr_spec":stats["n_pwr_spec"],
+                               "n_prescreen":stats["n_prescreen"],
+                               "n_prescreen_clipped":stats["n_prescreen_clipped"],
+                               "n_prescreen_peak":stats["n_prescreen_peak"],
+                               "n_prescreen_noise":stats["n_prescreen_noise"],
+                               "pwr_spec":pwr_spec})
             try:
-                t0=time.time()
-                # we should probably do a
-                # AA=n.dot(AA,Sinv)
-                # first. this would save all the Sinv dot products. no time to test and validate this now
-                # 
-                # A^H diag(1/sigma)
-                AT=n.conj(AA.T).dot(Sinv)
-                # A^H S^{-1} A (Fisher information matrix)
-                ATA=AT.dot(n.dot(Sinv,AA)).toarray()
-
-                # A^H \Sigma^{-1} m_g with ground clutter mitigation
-                # note that 1/sigma is taken earlier when forming mm_g and mm_e
-                # here we add a 1/sigma to get 1/sigma^2 on the diagonal of Sigma^{-1}
-                ATm_g=AT.dot(mm_g)
-                # A^H \Sigma^{-1} m_e no ground clutter mitigation
-                # note that 1/sigma is taken earlier when forming mm_g and mm_e
-                ATm_e=AT.dot(mm_e)
-
-                # error covariance
-                Sigma=n.linalg.inv(ATA)
-
-                # ML estimate for ACF lag without ground clutter mitigation measures in place
-                xhat_e=n.dot(Sigma,ATm_e)
-
-                # ML estimate for ACF lag with ground clutter mitigation measures            
-                xhat_g=n.dot(Sigma,ATm_g)
-
-                t1=time.time()
-                t_simple=t1-t0        
-                print("simple %1.2f"%(t_simple))
-                acfs_e[ rmins[li]:rmax, li ]=xhat_e[0:(rmax-rmins[li])]
-                noise_e[li]=xhat_e[len(xhat_e)-1]
-                acfs_g[ rmins[li]:rmax, li ]=xhat_g[0:(rmax-rmins[li])]
-                noise_g[li]=xhat_g[len(xhat_g)-1]                
-
-                acfs_var[ rmins[li]:rmax, li ] = n.diag(Sigma.real)[0:(rmax-rmins[li])]
-            except:
-                traceback.print_exc()
-                print("something went wrong.")
-
-        if n_good_estimates > 0:
-            print("saving")
-            if save_acf_images:
-                # plot real part of acf
-                acf_std=1.77*n.nanmedian(n.abs(acfs_e.real))
-                plt.pcolormesh(mean_lags,rgs_km[0:rmax],acfs_e.real,vmin=-acf_std,vmax=2*acf_std)
-                plt.xlabel("Lag ($\mu$s)")
-                plt.ylabel("Range (km)")
-                plt.colorbar()
-                plt.title("%s T_sys=%1.0f K"%(stuffr.unix2datestr(i0/sr),T_sys))
-                plt.tight_layout()
-                plt.savefig("%s/lpi_%d/%s/lpi-%d.png"%(dirname,rg,channel,i0/sr))
-                plt.close()
-                plt.clf()
-
-            #
-            # tbd: determine if this could be done better with digital_metadata
-            #
-            ho=h5py.File("%s/lpi_%d/%s/lpi-%d.h5"%(dirname,rg,channel,i0/sr),"w")
-            ho["acfs_g"]=acfs_g       # pulse to pulse ground clutter removal
-            ho["acfs_e"]=acfs_e       # no ground clutter removal
-            ho["noise_e"]=noise_e     # store estimated noise ACF
-            ho["noise_g"]=noise_g     # store estimated noise ACF   
-            ho["acfs_var"]=acfs_var   # variance of the acf estimate
-            ho["rgs_km"]=rgs_km[0:rmax]
-            ho["channel"]=channel
-            ho["P_tx"]=avg_pwr/avg_pwr_n
-            ho["lags"]=mean_lags/sr
-            # tbd: save t0 and t1 to indicate time span in this output
-            ho["i0"]=i0/sr
-            ho["T_sys"]=T_sys     # T_sys = alpha*noise_power
-            ho["alpha"]=alpha     # This can scale power to T_sys (e.g., noise_power = T_sys/alpha)   T_sys * power/noise_pwr = T_pwr
-            #
-            ho["z_dc"]=n.median(z_dc_samples)
-            ho["pass_band"]=pass_band        # sort of important to store this, as this defines the low pass filter  
-            ho["filter_len"]=filter_len      #
-            # keep track of how many lagged products are rejected as bad as a function of time delay
-            ho["retained_measurement_fraction"]=n.array(ok_count/meas_count,dtype=n.float32)
-            ho["meas_delays_us"]=meas_delays_us
-            ho["diagnostic_pwr_spec"]=pwr_spec/n_pwr_spec
-            ho.close()
-        else:
-            print("no estimates in this integration period")
+                if sliding:
+                    # the integration window is the sum of the last n_sub sub-windows
+                    sub={"i0":window["i0"],"stats":stats,"pwr_spec":n.copy(pwr_spec),"gate_state":gate_state}
+                    if not sliding_sums[channel].add(ai,sub):
+                        continue
+                    i0,gate_state,stats,pwr_spec_w=sliding_sums[channel].window()
+                    pwr_spec[:]=pwr_spec_w
+                    if channel not in window_channels(i0):
+                        continue
+
+                if joint:
+                    joint_parts.append((i0,gate_state,stats,n.copy(pwr_spec)))
+                    if not save_channels:
+                        continue
+
+                # the lag chunks are read from the stored products
+                invert_and_store(channel,i0,gate_state,stats,pwr_spec,collect_chunk)
+            finally:
+                if use_products:
+                    window["products"][channel].close()
+
+        if joint and len(joint_parts) == len(channels):
+            i0,gate_state,stats,pwr_spec_j=joint_parts[0]
+            # the receivers can have different gains. the lagged products of each are scaled to the
+            # units of the first channel with the noise injection
+            alphas=[]
+            for part in joint_parts:
+                st=part[2]
+                alphas.append((n.median(st["bg_plus_inj_samples"])-n.median(st["bg_samples"]))/T_injection)
+            scales=[]
+            for alpha in alphas:
+                if n.isfinite(alpha) and alpha > 0 and n.isfinite(alphas[0]) and alphas[0] > 0:
+                    scales.append(alphas[0]/alpha)
+                else:
+                    scales.append(1.0)
+            print("joint analysis of %s, scales %s"%(joint_channel," ".join(["%1.3f"%(sc) for sc in scales])))
+
+            joint_state=[]
+            for gi,gate in enumerate(gates):
+                psts=[part[1][gi] for part in joint_parts]
+                jst={"ok_count":n.sum([pst["ok_count"] for pst in psts],axis=0),
+                     "meas_count":n.sum([pst["meas_count"] for pst in psts],axis=0),
+                     "n_noise":len(channels),
+                     "outlier_stats":[None]*n_lags,
+                     "ne":[]}
+                for li in range(n_lags):
+                    # the ratio test statistics are only used to check that a lag has enough measurements
+                    for pst in psts:
+                        if pst["outlier_stats"][li] is not None:
+                            jst["outlier_stats"][li]=pst["outlier_stats"][li]
+                    jst["ne"].append(joint_normal_equations([pst["ne"][li] for pst in psts],scales))
+                if "ne_g" in psts[0].keys():
+                    jst["ne_g"]=[]
+                    for li in range(n_lags):
+                        jst["ne_g"].append(joint_normal_equations([pst["ne_g"][li] for pst in psts],scales))
+                joint_state.append(jst)
+            invert_and_store(joint_channel,i0,joint_state,stats,pwr_spec_j)
+
+    # theory matrix plans depend on the transmit pulses seen, so they are stored at the end
+    if plan_file is not None and rank == 0:
+        save_convolution_plans(plan_file)
+
+def reinvert_lpi(dirname,
+                 channel="zenith-l",
+                 rg=60,
+                 min_tx_frac=0.5,
+                 maximum_range_delay=7000,
+                 lag_avg=1,
+                 ratio_threshold=10.0,
+                 sigma_threshold=100.0,
+                 solver="inv",
+                 streaming=False,
+                 save_acf_images=True,
+                 gc_max_delay=None,
+                 joint=False,
+                 postfix="_re"):
+    """
+    redo the outlier rejection and the lag-profile inversion from lagged products stored
+    with lpi_files(save_products=True), e.g., with different outlier thresholds, range gates
+    or lag averaging. the range gates need to be multiples of the stored range decimation.
+    the results go into lpi_<rg><postfix>/<channel>
+    """
+    if isinstance(channel,str):
+        channels=[channel]
+    else:
+        channels=list(channel)
+    fl=sorted(glob.glob("%s/lpi_products/%s/products-*.h5"%(dirname,channels[0])))
+    if len(fl) == 0:
+        print("no stored lagged products found in %s/lpi_products/%s"%(dirname,channels[0]))
+        return
+    # the settings of the run that stored the lagged products
+    h=h5py.File(fl[0],"r")
+    avg_dur=float(h["avg_dur"][()])
+    lags=n.array(h["lags"][()],dtype=int)
+    pass_band=float(h["pass_band"][()])
+    filter_len=int(h["filter_len"][()])
+    h.close()
+
+    lpi_files(dirname=dirname,
+              avg_dur=avg_dur,
+              channel=channels,
+              rg=rg,
+              min_tx_frac=min_tx_frac,
+              reanalyze=True,
+              pass_band=pass_band,
+              filter_len=filter_len,
+              maximum_range_delay=maximum_range_delay,
+              save_acf_images=save_acf_images,
+              lags=lags,
+              lag_avg=lag_avg,
+              streaming=streaming,
+              solver=solver,
+              use_products=True,
+              ratio_threshold=ratio_threshold,
+              sigma_threshold=sigma_threshold,
+              gc_max_delay=gc_max_delay,
+              joint=joint,
+              postfix=postfix)
 
 if __name__ == "__main__":
 
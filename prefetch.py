@@ -0,0 +1,52 @@
+import threading
+import queue
+import traceback
+
+class window_prefetcher:
+    """
+    loads integration windows in a background thread, so that reading the raw voltage
+    of the next window overlaps with processing the current one. the queue is bounded, so at most
+    depth windows are read ahead.
+
+    iterating gives (ai, load(ai)) in the order of todo. the window is None if loading failed.
+    """
+    def __init__(self,load,todo,depth=1):
+        self.load=load
+        self.todo=list(todo)
+        self.q=queue.Queue(maxsize=depth)
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for ai in self.todo:
+            try:
+                window=self.load(ai)
+            except:
+                traceback.print_exc()
+                window=None
+            self.q.put((ai,window))
+        self.q.put(None)
+
+    def __iter__(self):
+        while True:
+            item=self.q.get()
+            if item is None:
+                return
+            yield(item)
+
+def iterate_windows(load,todo,prefetch=True,depth=1):
+    """
+    (ai, load(ai)) for all integration windows in todo, read ahead in a background thread
+    if prefetch is True.
+    """
+    if prefetch:
+        for item in window_prefetcher(load,todo,depth=depth):
+            yield(item)
+    else:
+        for ai in todo:
+            try:
+                window=load(ai)
+            except:
+                traceback.print_exc()
+                window=None
+            yield((ai,window))
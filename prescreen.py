@@ -0,0 +1,85 @@
+import collections
+import numpy as n
+
+class pulse_prescreen:
+    """
+    cheap quality check of the raw echoes of one pulse, done before filtering and lagged products.
+    pulses hit by RFI bursts, receiver saturation or a bright hard target would be rejected by the
+    ratio test anyway, after all of the expensive work has been done.
+
+    three statistics are calculated from the echo part of the raw voltage (gc:last_echo):
+    - the number of clipped samples (|re| or |im| at least clip_level)
+    - the peak power of the ground clutter subtracted echo (z[0]-z[1]) in each block of block_len range
+      samples, relative to the median power of that block. the median is taken over the previous good
+      pulses, or over the samples of this pulse until there are enough of them
+    - the background noise power before last_echo, compared to the median of the previous good pulses
+
+    checks of the same pulses in the same order always give the same result, so the
+    lagged products can be iterated over more than once.
+    """
+    def __init__(self,
+                 max_noise_ratio=4.0,
+                 max_peak_ratio=1000.0,
+                 clip_level=32000.0,
+                 max_clipped=10,
+                 n_ref=20,
+                 noise_len=500,
+                 block_len=100):
+        """
+        None disables a check. n_ref is the number of good pulses used as the noise and range profile reference
+        """
+        self.max_noise_ratio=max_noise_ratio
+        self.max_peak_ratio=max_peak_ratio
+        self.clip_level=clip_level
+        self.max_clipped=max_clipped
+        self.noise_len=noise_len
+        self.block_len=block_len
+        self.n_ref=n_ref
+        self.noise_ref=collections.deque(maxlen=n_ref)
+        # range block median powers of the previous good pulses, for each echo range (gc,last_echo)
+        self.profile_ref={}
+        self.counts={"checked":0,"clipped":0,"peak":0,"noise":0}
+
+    def statistics(self,z,gc,last_echo):
+        """
+        background noise power and number of clipped samples of each row of z (n_echoes, n_samples),
+        and the peak and median power in each range block of the ground clutter subtracted echo
+        """
+        ze=z[:,gc:last_echo]
+        p=ze.real**2.0+ze.imag**2.0
+        noise_pwr=n.mean(p[:,(p.shape[1]-self.noise_len):],axis=1)
+        n_clipped=n.sum((n.abs(ze.real) >= self.clip_level) | (n.abs(ze.imag) >= self.clip_level),axis=1)
+        zd=ze[0,:]-ze[1,:]
+        n_blocks=int(len(zd)/self.block_len)
+        pd=(zd.real**2.0+zd.imag**2.0)[0:(n_blocks*self.block_len)].reshape([n_blocks,self.block_len])
+        return(noise_pwr,n.max(pd,axis=1),n.median(pd,axis=1),n_clipped)
+
+    def check(self,z,gc,last_echo):
+        """
+        check the echoes z (n_echoes, n_samples) of one pulse, i.e., the echo and the one that is
+        subtracted from it for ground clutter removal. returns None if the pulse is good, otherwise
+        the reason for rejecting it
+        """
+        self.counts["checked"]+=1
+        noise_pwr,peak_pwr,block_pwr,n_clipped=self.statistics(z,gc,last_echo)
+        # median power of each range block
+        if (gc,last_echo) not in self.profile_ref.keys():
+            self.profile_ref[(gc,last_echo)]=collections.deque(maxlen=self.n_ref)
+        profile_ref=self.profile_ref[(gc,last_echo)]
+        median_pwr=block_pwr
+        if len(profile_ref) > 4:
+            median_pwr=n.median(n.array(profile_ref),axis=0)
+        reason=None
+        if self.max_clipped is not None and n.max(n_clipped) > self.max_clipped:
+            reason="clipped"
+        elif self.max_peak_ratio is not None and n.max(peak_pwr/median_pwr) > self.max_peak_ratio:
+            reason="peak"
+        elif self.max_noise_ratio is not None and len(self.noise_ref) > 4 and n.max(noise_pwr) > self.max_noise_ratio*n.median(self.noise_ref):
+            reason="noise"
+
+        if reason is None:
+            self.noise_ref.append(noise_pwr[0])
+            profile_ref.append(block_pwr)
+        else:
+            self.counts[reason]+=1
+        return(reason)
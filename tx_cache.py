@@ -0,0 +1,48 @@
+import numpy as n
+
+class ambiguity_cache:
+    """
+    cache of transmit pulse products (lagged products, range-Doppler ambiguity functions),
+    keyed by pulse code.
+
+    the transmit waveform of one pulse code changes very little from pulse to pulse, so the products
+    only need to be recalculated when the transmitter drifts. this is detected with the normalized
+    correlation between the transmit envelope and the one that the cached products were calculated with.
+    the cached products include the noise of the first pulse, which biases the estimates slightly
+    (1-5% in simulated ACFs with 0.05% transmitter jitter), so the cache is not used by default.
+    """
+    def __init__(self,compute,min_corr=0.999):
+        """
+        compute(z_tx) calculates the products for transmit envelope z_tx.
+        min_corr=None disables the cache.
+        """
+        self.compute=compute
+        self.min_corr=min_corr
+        self.entries={}
+        self.n_hit=0
+        self.n_miss=0
+
+    def correlation(self,z0,z1):
+        """
+        normalized correlation, which does not depend on the phase or amplitude of the pulse
+        """
+        return(n.abs(n.vdot(z0,z1))/n.sqrt(n.real(n.vdot(z0,z0))*n.real(n.vdot(z1,z1))))
+
+    def get(self,code,z_tx):
+        """
+        products for transmit envelope z_tx of pulse code code. the result is shared, don't modify it
+        """
+        if self.min_corr is None:
+            return(self.compute(z_tx))
+
+        if code in self.entries.keys():
+            z_cached,products=self.entries[code]
+            if len(z_cached) == len(z_tx) and self.correlation(z_cached,z_tx) >= self.min_corr:
+                self.n_hit+=1
+                return(products)
+
+        # new code or the transmitter has changed
+        self.n_miss+=1
+        products=self.compute(z_tx)
+        self.entries[code]=(n.copy(z_tx),products)
+        return(products)